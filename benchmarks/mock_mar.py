@@ -0,0 +1,95 @@
+import base64, hashlib, json, random, threading, time, urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the MAR endpoints used by dcgeotools: locationbatch,
+# locations/{lon},{lat}/200m and ssls?square=. Results are derived from a hash
+# of the request so runs are reproducible. Addresses containing "zzz" or
+# starting with "!" (see address_to_MAR) are unknown to the mock. With
+# fail_status every request is answered with that HTTP status.
+class MockMAR:
+  def __init__(self, latency=0.0, error_rate=0.0, batch_fail=True, seed=0, fail_status=None):
+    self.latency = latency
+    self.error_rate = error_rate
+    self.fail_status = fail_status
+    self.batch_fail = batch_fail
+    self.random = random.Random(seed)
+    self.requests = 0
+    self.request_bytes = 0
+    self.lock = threading.Lock()
+    self.server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(self))
+    self.server.daemon_threads = True
+    self.url = "http://127.0.0.1:{}/mar/open/api/v2.0".format(self.server.server_address[1])
+
+  def start(self):
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def __enter__(self):
+    return self.start()
+
+  def __exit__(self, *exc):
+    self.stop()
+
+  # True when this request should fail with a transient 503
+  def transient_failure(self):
+    with self.lock:
+      self.requests += 1
+      return self.random.random() < self.error_rate
+
+def _hash(text):
+  return int(hashlib.md5(text.encode()).hexdigest(), 16)
+
+def _known(address):
+  return not (address.startswith("!") or "zzz" in address)
+
+def _properties(address):
+  h = _hash(address)
+  return {"Latitude":38.82 + (h % 10000) / 62500, "Longitude":-77.09 + (h // 10000 % 10000) / 62500, "ResidenceType":"RESIDENTIAL", "SSL":"{:04d}    {:04d}".format(h % 900, h % 37), "FullAddress":address.upper()}
+
+def _handler(mock):
+  class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, avoid delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+      pass
+
+    def send_json(self, status, data):
+      body = json.dumps(data).encode()
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def do_GET(self):
+      # Request line and headers as received
+      with mock.lock:
+        mock.request_bytes += len(self.raw_requestline) + sum(len(k) + len(v) + 4 for k, v in self.headers.items()) + 2
+      if mock.latency: time.sleep(mock.latency)
+      if mock.transient_failure(): return self.send_json(503, {"error":"unavailable"})
+      if mock.fail_status: return self.send_json(mock.fail_status, {"error":"failed"})
+      url = urllib.parse.urlsplit(self.path)
+      if "/locationbatch/" in url.path:
+        addresses = base64.b64decode(urllib.parse.unquote(url.path.split("/locationbatch/")[1])).decode().split("||")
+        # MAR fails the whole batch when one address is bad
+        if mock.batch_fail and len(addresses) > 1 and not all(_known(a) for a in addresses):
+          return self.send_json(400, {"error":"bad address in batch"})
+        results = []
+        for address in addresses:
+          if _known(address): results.append({"Result":{"addresses":[{"address":{"properties":_properties(address)}}]}})
+          else: results.append({"Result":{}})
+        return self.send_json(200, {"Results":results})
+      if "/locations/" in url.path:
+        return self.send_json(200, {"Result":[{"address":{"properties":{"SSL":None}}}, {"address":{"properties":_properties(url.path)}}]})
+      if url.path.endswith("/ssls"):
+        square = urllib.parse.parse_qs(url.query)["square"][0]
+        street = ["MAIN ST NW", "ELM ST SE", "OAK AVE NE", "PINE PL SW"][_hash(square) % 4]
+        return self.send_json(200, {"Result":{"ssls":[{"FullAddress":"100 {} {}".format(square, street)}, {"FullAddress":None}, {"FullAddress":"200 {}".format(street)}]}})
+      self.send_json(404, {"error":"not found"})
+  return Handler
@@ -0,0 +1,116 @@
+import argparse, json, os, platform, sys, tempfile, time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import dcgeotools
+from mock_mar import MockMAR
+from synthetic import dc_points, address_corpus
+
+# Runs func once with instrumentation enabled and returns wall time and metrics
+def measure(func, *args, **kwargs):
+  recorder = dcgeotools.enable_instrumentation()
+  start = time.perf_counter()
+  try:
+    result = func(*args, **kwargs)
+  finally:
+    seconds = time.perf_counter() - start
+    dcgeotools.disable_instrumentation()
+  return result, {"seconds":seconds, **recorder.to_dict()}
+
+def bench_clusters(sizes, args):
+  for n in sizes:
+    points = dc_points(n, seed=args.seed)
+    clusters, metrics = measure(dcgeotools.get_clusters, points, args.cluster_radius, args.cluster_points)
+    yield {"n":n, "clusters":len(clusters), **metrics}
+
+def bench_regions(sizes, args):
+  for n in sizes:
+    points = dc_points(n, seed=args.seed)
+    regions, metrics = measure(dcgeotools.get_regions, points)
+    yield {"n":n, "function":"get_regions", "located":int(regions["ward"].notna().sum()), **metrics}
+    regions, metrics = measure(dcgeotools.lookup_regions, points["lat"].to_numpy(), points["lon"].to_numpy())
+    yield {"n":n, "function":"lookup_regions", "located":int((~np.isnan(regions["ward"])).sum()), **metrics}
+
+def bench_normalize(sizes, args):
+  for n in sizes:
+    corpus = address_corpus(n, args.error_rate, args.duplicate_rate, seed=args.seed)
+    (codes, uniques), metrics = measure(dcgeotools.addresses_to_MAR, corpus)
+    yield {"n":n, "function":"addresses_to_MAR", "distinct":len(uniques), **metrics}
+    _, metrics = measure(lambda: [dcgeotools.address_to_MAR(a) for a in corpus])
+    yield {"n":n, "function":"address_to_MAR", **metrics}
+
+def bench_geocode(sizes, args):
+  with MockMAR(args.latency, args.transient_rate, seed=args.seed) as mar:
+    dcgeotools.MAR_URL = mar.url
+    for n in sizes:
+      corpus = address_corpus(n, args.error_rate, args.duplicate_rate, seed=args.seed)
+      for workers in args.workers:
+        result, metrics = measure(dcgeotools.geocode, corpus, "benchmark", batch_size=args.batch_size, max_workers=workers, retries=3, backoff=0.01)
+        yield {"n":n, "max_workers":workers, "status":{k:int(v) for k, v in result["status"].value_counts().items()}, **metrics}
+      # Second run answered from a warm cache
+      with tempfile.TemporaryDirectory() as tmp:
+        cache = dcgeotools.GeocodeCache(os.path.join(tmp, "cache.db"))
+        for run in ["cold", "warm"]:
+          result, metrics = measure(dcgeotools.geocode, corpus, "benchmark", batch_size=args.batch_size, max_workers=max(args.workers), retries=3, backoff=0.01, cache=cache)
+          yield {"n":n, "cache":run, "max_workers":max(args.workers), **metrics}
+        cache.close()
+
+def bench_intersections(sizes, args):
+  with MockMAR(args.latency, args.transient_rate, seed=args.seed) as mar:
+    dcgeotools.MAR_URL = mar.url
+    for n in sizes:
+      points = dc_points(n, seed=args.seed)
+      # Repeated incident locations, as in reporting over nearby incidents
+      locations = [tuple(p) for p in points[["lat", "lon"]].round(3).to_numpy()]
+      dcgeotools._square_intersections.entries.clear()
+      _, metrics = measure(dcgeotools.get_intersections, locations, "benchmark", max_workers=max(args.workers), retries=3, backoff=0.01)
+      yield {"n":n, "function":"get_intersections", **metrics}
+      if n <= args.serial_limit:
+        dcgeotools._square_intersections.entries.clear()
+        _, metrics = measure(lambda: [dcgeotools.get_intersection(l, "benchmark") for l in locations])
+        yield {"n":n, "function":"get_intersection", **metrics}
+
+suites = {
+  "clusters":bench_clusters,
+  "regions":bench_regions,
+  "normalize":bench_normalize,
+  "geocode":bench_geocode,
+  "intersections":bench_intersections
+}
+
+def sizes(text):
+  return [int(float(s)) for s in text.split(",")]
+
+def main():
+  parser = argparse.ArgumentParser(description="dcgeotools benchmarks against synthetic DC data and a local mock MAR server")
+  parser.add_argument("--suites", default=",".join(suites), help="comma separated suites: " + ", ".join(suites))
+  parser.add_argument("--sizes", type=sizes, default=sizes("1e3,1e4,1e5,1e6"), help="point and address counts for local suites")
+  parser.add_argument("--cluster-sizes", type=sizes, help="point counts for the clusters suite, --sizes by default")
+  parser.add_argument("--mar-sizes", type=sizes, default=sizes("1e3,1e4"), help="address and location counts for suites using the mock MAR server")
+  parser.add_argument("--seed", type=int, default=0)
+  parser.add_argument("--cluster-radius", type=float, default=0.1)
+  parser.add_argument("--cluster-points", type=int, default=5)
+  parser.add_argument("--error-rate", type=float, default=0.02, help="share of addresses unknown to MAR")
+  parser.add_argument("--duplicate-rate", type=float, default=0.3, help="share of addresses repeating an earlier one")
+  parser.add_argument("--latency", type=float, default=0.02, help="mock MAR seconds per request")
+  parser.add_argument("--transient-rate", type=float, default=0.0, help="share of mock MAR requests failing with 503")
+  parser.add_argument("--batch-size", type=int, default=40)
+  parser.add_argument("--workers", type=sizes, default=sizes("1,8"), help="max_workers values for geocode")
+  parser.add_argument("--serial-limit", type=int, default=1000, help="largest size to also run get_intersection one location at a time")
+  parser.add_argument("--output", help="write results as JSON to this file")
+  args = parser.parse_args()
+
+  results = {"python":platform.python_version(), "platform":platform.platform(), "args":vars(args), "suites":{}}
+  suite_sizes = {"clusters":args.cluster_sizes or args.sizes, "geocode":args.mar_sizes, "intersections":args.mar_sizes}
+  for name in args.suites.split(","):
+    results["suites"][name] = []
+    for row in suites[name](suite_sizes.get(name, args.sizes), args):
+      results["suites"][name].append(row)
+      print("{:<14}{}".format(name, json.dumps({k:v for k, v in row.items() if k not in ("timings", "counters")})), flush=True)
+
+  if args.output:
+    with open(args.output, "w") as f:
+      json.dump(results, f, indent=2, default=str)
+
+if __name__ == "__main__":
+  main()
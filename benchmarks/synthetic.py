@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+# Bounding box of DC
+DC_BOUNDS = (38.791, -77.120, 38.996, -76.909)
+
+# Points spread over DC with a share gathered around hot spots, like incidents
+def dc_points(n, seed=0, hotspots=50, hotspot_share=0.3, hotspot_miles=0.2):
+  rng = np.random.default_rng(seed)
+  lat0, lon0, lat1, lon1 = DC_BOUNDS
+  lat = rng.uniform(lat0, lat1, n)
+  lon = rng.uniform(lon0, lon1, n)
+  clustered = rng.random(n) < hotspot_share
+  centers = rng.integers(0, hotspots, clustered.sum())
+  center_lat = rng.uniform(lat0, lat1, hotspots)
+  center_lon = rng.uniform(lon0, lon1, hotspots)
+  # About 69 miles per degree of latitude, 54 per degree of longitude in DC
+  lat[clustered] = center_lat[centers] + rng.normal(0, hotspot_miles / 69, clustered.sum())
+  lon[clustered] = center_lon[centers] + rng.normal(0, hotspot_miles / 54, clustered.sum())
+  return pd.DataFrame({"lat":lat, "lon":lon})
+
+_streets = ["Main", "Elm", "Oak", "Pennsylvania", "Massachusetts", "Georgia", "Rhode Island", "Benning", "Minnesota", "Martin Luther King Jr"]
+_suffixes = ["St", "Ave", "Ave.", "Rd", "Pl", "Blvd"]
+_quadrants = ["NW", "NE", "SE", "SW"]
+_units = ["", "", "", " Apt 2", " #301", " APT. 4B"]
+_towns = ["", "", ", Washington DC", ", WASHINGTON DC"]
+
+# Raw address strings; error_rate of them are unknown to MAR (the mock treats
+# "zzz" as unknown) and duplicate_rate repeat an earlier address
+def address_corpus(n, error_rate=0.02, duplicate_rate=0.3, seed=0):
+  rng = np.random.default_rng(seed)
+  addresses = []
+  for i in range(n):
+    if addresses and rng.random() < duplicate_rate:
+      addresses.append(addresses[rng.integers(0, len(addresses))])
+    elif rng.random() < error_rate:
+      addresses.append(["zzz unknown place {}".format(i), "nowhere", np.nan][rng.integers(0, 3)])
+    else:
+      addresses.append("{} {} {} {}{}{}".format(rng.integers(1, 5000), _streets[rng.integers(0, len(_streets))], _suffixes[rng.integers(0, len(_suffixes))], _quadrants[rng.integers(0, 4)], _units[rng.integers(0, len(_units))], _towns[rng.integers(0, len(_towns))]))
+  return addresses
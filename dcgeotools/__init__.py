@@ -1,9 +1,186 @@
-import math, base64, json, urllib.request, re
-import geopandas as gpd
-import pandas as pd
+import math, base64, json, urllib.error, urllib.parse, re, threading, time, queue, http.client, sqlite3, os, itertools, collections
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
-import base64, pkg_resources
+from dcgeotools import instrumentation
+from dcgeotools.instrumentation import Instrumentation, enable_instrumentation, disable_instrumentation, instrumented
+from dcgeotools.grid import lookup_regions
+
+# pandas, geopandas, shapely and scipy are imported where used so that the
+# grid region lookup in dcgeotools.grid starts with only NumPy
+
+# MAR API root, can be pointed at a stand-in server
+MAR_URL = "https://datagate.dc.gov/mar/open/api/v2.0"
+
+# Token bucket allowing rate requests per second with bursts up to capacity
+class _TokenBucket:
+  def __init__(self, rate, capacity=None):
+    self.rate = float(rate)
+    self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+# Counts bytes written to MAR, request line and headers included
+class _CountingConnection:
+  def send(self, data):
+    if isinstance(data, (bytes, bytearray)): instrumentation.count("mar_bytes_sent", len(data))
+    super().send(data)
+
+class _HTTPConnection(_CountingConnection, http.client.HTTPConnection):
+  pass
+
+class _HTTPSConnection(_CountingConnection, http.client.HTTPSConnection):
+  pass
+
+# Keep-alive connections to MAR shared between threads, with optional rate
+# limiting and retry with exponential backoff on transient errors
+class _MARSession:
+  transient_status = (429, 500, 502, 503, 504)
+  # Statuses MAR answers a request containing a bad address with
+  address_status = (400, 404, 414)
+
+  def __init__(self, rate_limit=None, retries=0, backoff=0.5, timeout=60):
+    self.rate_limit = _TokenBucket(rate_limit) if rate_limit else None
+    self.retries = retries
+    self.backoff = backoff
+    self.timeout = timeout
+    self.idle = queue.LifoQueue()
+
+  def _connect(self, url):
+    if url.scheme == "https":
+      return _HTTPSConnection(url.netloc, timeout=self.timeout)
+    return _HTTPConnection(url.netloc, timeout=self.timeout)
+
+  def _get(self, url):
+    try:
+      conn = self.idle.get_nowait()
+      reused = True
+      if conn.host_url != (url.scheme, url.netloc):
+        conn.close()
+        raise queue.Empty
+    except queue.Empty:
+      conn = self._connect(url)
+      conn.host_url = (url.scheme, url.netloc)
+      reused = False
+      instrumentation.count("mar_connections")
+    path = url.path + ("?" + url.query if url.query else "")
+    try:
+      conn.request("GET", path, headers={"Accept": "application/json"})
+      response = conn.getresponse()
+      body = response.read()
+    except (http.client.HTTPException, OSError):
+      conn.close()
+      # Server dropped an idle keep-alive connection, try once on a new one
+      if reused: return self._get(url)
+      raise
+    instrumentation.count("mar_requests")
+    instrumentation.count("mar_bytes_received", len(body))
+    if response.will_close: conn.close()
+    else: self.idle.put(conn)
+    if response.status >= 400:
+      raise urllib.error.HTTPError(url.geturl(), response.status, response.reason, response.headers, None)
+    return body
+
+  def get_json(self, request):
+    url = urllib.parse.urlsplit(request)
+    for attempt in range(self.retries + 1):
+      if self.rate_limit: self.rate_limit.acquire()
+      try:
+        return json.loads(self._get(url).decode())
+      except urllib.error.HTTPError as e:
+        if e.code not in self.transient_status or attempt == self.retries: raise
+      except (http.client.HTTPException, OSError):
+        if attempt == self.retries: raise
+      instrumentation.count("mar_retries")
+      time.sleep(self.backoff * 2 ** attempt)
+
+  def close(self):
+    while True:
+      try: self.idle.get_nowait().close()
+      except queue.Empty: return
+
+_default_session = _MARSession()
+
+# Persistent geocode results keyed by MAR address. Addresses MAR could not
+# geocode are stored as negative results (NaN coordinates). Entries expire
+# after ttl seconds and the least recently used are evicted past max_entries.
+class GeocodeCache:
+  def __init__(self, path, ttl=None, max_entries=None):
+    self.path = path
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = threading.Lock()
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.db.execute("CREATE TABLE IF NOT EXISTS geocode (address TEXT PRIMARY KEY, lat REAL, lon REAL, type TEXT, created REAL, accessed REAL)")
+    self.db.execute("CREATE INDEX IF NOT EXISTS geocode_accessed ON geocode (accessed)")
+    self.db.commit()
+
+  def __len__(self):
+    with self.lock:
+      return self.db.execute("SELECT COUNT(*) FROM geocode").fetchone()[0]
+
+  # takes [MAR address], returns {MAR address: {"lat", "lon", "type"}} for cached addresses
+  def get_many(self, addresses):
+    addresses = list(dict.fromkeys(addresses))
+    now = time.time()
+    cutoff = now - self.ttl if self.ttl is not None else -math.inf
+    found = {}
+    with self.lock:
+      for i in range(0, len(addresses), 500):
+        chunk = addresses[i:i+500]
+        rows = self.db.execute("SELECT address, lat, lon, type FROM geocode WHERE created >= ? AND address IN ({})".format(",".join("?" * len(chunk))), [cutoff] + chunk)
+        for address, lat, lon, location_type in rows:
+          found[address] = {"lat":np.nan if lat is None else lat, "lon":np.nan if lon is None else lon, "type":np.nan if location_type is None else location_type}
+      self.db.executemany("UPDATE geocode SET accessed = ? WHERE address = ?", [(now, address) for address in found])
+      self.db.commit()
+      self.hits += len(found)
+      self.misses += len(addresses) - len(found)
+    instrumentation.count("geocode_cache_hits", len(found))
+    instrumentation.count("geocode_cache_misses", len(addresses) - len(found))
+    return found
+
+  # takes {MAR address: {"lat", "lon", "type"}}
+  def put_many(self, results):
+    now = time.time()
+    def value(v):
+      return None if isinstance(v, float) and np.isnan(v) else v
+    with self.lock:
+      self.db.executemany("INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?, ?)", [(address, value(r["lat"]), value(r["lon"]), value(r["type"]), now, now) for address, r in results.items()])
+      if self.ttl is not None:
+        self.db.execute("DELETE FROM geocode WHERE created < ?", (now - self.ttl,))
+      if self.max_entries is not None:
+        excess = self.db.execute("SELECT COUNT(*) FROM geocode").fetchone()[0] - self.max_entries
+        if excess > 0:
+          self.db.execute("DELETE FROM geocode WHERE address IN (SELECT address FROM geocode ORDER BY accessed LIMIT ?)", (excess,))
+          self.evictions += excess
+      self.db.commit()
+
+  def stats(self):
+    return {"hits":self.hits, "misses":self.misses, "evictions":self.evictions, "entries":len(self)}
+
+  def clear(self):
+    with self.lock:
+      self.db.execute("DELETE FROM geocode")
+      self.db.commit()
+
+  def close(self):
+    self.db.close()
 
 def address_to_MAR(address):
   if type(address) is float or not " " in address:
@@ -18,163 +195,343 @@ def address_to_MAR(address):
   url_string = address.lower().replace(", washington dc", "").replace(".", "").replace(",", "").replace("?", "").replace("blk", "").replace("block", "").replace("of", "").replace("-", " ").replace("/", " and ").replace("\\", " and ")
   return re.sub(" +", " ", url_string)
 
+# Steps of address_to_MAR merged into single regex passes: truncation at " apt"
+# or "#" with the city and punctuation removed before it, and hyphens with
+# repeated spaces (lone spaces are left alone, rewriting them is slow).
+# Removing "blk", "block" and "of" can form the next pattern, so those stay
+# sequential.
+_truncate_pattern = r"(?s) apt.*|#.*|, washington dc|[.,?]"
+_separator_pattern = r" [- ]+|-[- ]*"
+
+# address_to_MAR over a pyarrow string array of ASCII addresses containing a space
+def _arrow_addresses_to_MAR(addresses):
+  import pyarrow.compute as pc
+  mar = pc.replace_substring_regex(pc.utf8_lower(addresses), _truncate_pattern, "")
+  for removed in ["blk", "block", "of"]:
+    mar = pc.replace_substring(mar, removed, "")
+  for removed in ["/", "\\"]:
+    mar = pc.replace_substring(mar, removed, " and ")
+  return pc.replace_substring_regex(mar, _separator_pattern, " ")
+
+# takes Series or list of addresses
+# Returns (codes, uniques) where uniques[codes] is address_to_MAR of each address
+@instrumented
+def addresses_to_MAR(addresses):
+  import pandas as pd
+  # Normalize each distinct address once
+  raw_codes, raw = pd.factorize(pd.Series(addresses, dtype=object), use_na_sentinel=False)
+  raw = pd.Series(raw, dtype=object)
+  mar = np.empty(len(raw), dtype=object)
+
+  # With pyarrow the string operations run natively. Lowercasing only matches
+  # Python's for ASCII, other addresses go through address_to_MAR.
+  vectorized = np.zeros(len(raw), dtype=bool)
+  try:
+    import pyarrow
+    vectorized = raw.map(lambda address: isinstance(address, str) and " " in address and address.isascii()).to_numpy(dtype=bool)
+    if vectorized.any():
+      mar[vectorized] = _arrow_addresses_to_MAR(pyarrow.array(raw[vectorized].tolist(), type=pyarrow.string())).to_numpy(zero_copy_only=False)
+  except ImportError:
+    pass
+  mar[~vectorized] = [address_to_MAR(address) for address in raw[~vectorized]]
+
+  mar_codes, uniques = pd.factorize(mar, use_na_sentinel=False)
+  return mar_codes[raw_codes], np.asarray(uniques, dtype=object)
+
 # takes [MAR address]
-def get_geodata(addresses, apikey):
+# Returns one result per address, None where MAR has no location
+@instrumented
+def get_geodata(addresses, apikey, session=None):
+  if session is None: session = _default_session
   if type(addresses) == str: addresses = [addresses]
   addresses = base64.b64encode("||".join(addresses).encode("ascii")).decode("utf-8")
-  request = "https://datagate.dc.gov/mar/open/api/v2.0/locationbatch/{}?address_separator=%7C%7C&chunkSequnce_separator=%3A&parallel=false&apikey={}".format(addresses,apikey)
-  with urllib.request.urlopen(request) as url:
-      data = json.loads(url.read().decode())
-      address_list = []
-      for d in data["Results"]:
-        first_key = next(iter(d["Result"]))
-        second_key = next(iter(d["Result"][first_key][0]))
-        address_data = d["Result"][first_key][0][second_key]["properties"]
-      return address_data
+  request = "{}/locationbatch/{}?address_separator=%7C%7C&chunkSequnce_separator=%3A&parallel=false&apikey={}".format(MAR_URL,addresses,apikey)
+  data = session.get_json(request)
+  address_list = []
+  for d in data["Results"]:
+    try:
+      first_key = next(iter(d["Result"]))
+      second_key = next(iter(d["Result"][first_key][0]))
+      address_list.append(d["Result"][first_key][0][second_key]["properties"])
+    except (StopIteration, LookupError, TypeError):
+      address_list.append(None)
+  return address_list
 
 # takes [address] or (address)
-def geocode(address_data, apikey, batch_size=40):
+@instrumented
+def geocode(address_data, apikey, batch_size=40, max_workers=1, rate_limit=None, retries=0, backoff=0.5, cache=None, offline=False, progress=None):
+  import pandas as pd
   if type(address_data) == str: address_data = [address_data]
+  if offline and cache is None: raise ValueError("offline geocoding requires a cache")
+
+  # (lat, lon, type, status, error) for a MAR result
+  def result_row(address_result):
+    if address_result is None: return (np.nan, np.nan, np.nan, "not found", "no MAR location")
+    return (address_result["Latitude"], address_result["Longitude"], address_result["ResidenceType"] if "ResidenceType" in address_result else "INTERSECTION", "ok", None)
+
+  # MAR rejecting the addresses, an address that cannot be encoded or a
+  # result count mismatch is caused by an address. Network errors, other HTTP
+  # statuses (e.g. 401/403 for a bad API key) and responses that cannot be
+  # parsed are not.
+  def address_failure(e):
+    if isinstance(e, urllib.error.HTTPError): return e.code in _MARSession.address_status
+    return isinstance(e, ValueError) and not isinstance(e, json.JSONDecodeError)
 
-  addresses = pd.DataFrame(columns=["lat", "lon", "type"])
-  for i in range(len(address_data)):
-    print("{}/{}".format(i*batch_size+1,len(address_data)))
-    # Try addresses in batch
-    if address_data[i*batch_size:(i*batch_size)+batch_size] == []: break
-    addys = [address_to_MAR(addy) for addy in address_data[i*batch_size:(i*batch_size)+batch_size]]
-    if addys == []: break
+  def failure_row(e):
+    status = "not found" if address_failure(e) else "error"
+    return (np.nan, np.nan, np.nan, status, str(e) or type(e).__name__)
+
+  # Addresses MAR answered, with or without a location. Only these are cached.
+  answered = set()
+  lock = threading.Lock()
+
+  # When an address breaks a batch, split it to isolate the bad addresses.
+  # Other failures mark the whole batch as an error without more requests.
+  def geocode_addresses(addys):
     try:
-      address_result = get_geodata(addys, apikey)
-      addresses.loc[len(addresses)] = {"lat":address_result["Latitude"], "lon":address_result["Longitude"], "type":address_result["ResidenceType"] if "ResidenceType" in address_result else "INTERSECTION"}
-    # When something breaks, test each individually
+      address_results = get_geodata(addys, apikey, session)
+      if len(address_results) != len(addys): raise ValueError("MAR returned {} results for {} addresses".format(len(address_results), len(addys)))
+      with lock:
+        answered.update(addys)
+      return {addy:result_row(r) for addy, r in zip(addys, address_results)}
     except Exception as e:
-      for addy in addys:
-        try: 
-          address_result = get_geodata(addy, apikey)
-          addresses.loc[len(addresses)] = {"lat":address_result["Latitude"], "lon":address_result["Longitude"], "type":address_result["ResidenceType"] if "ResidenceType" in address_result else "INTERSECTION"}
-        except Exception as e2:
-          print(e2)
-          addresses.loc[len(addresses)] = {"lat":np.nan, "lon":np.nan, "type":np.nan}
-          print("Address failure:", addy)
-  return addresses
+      if len(addys) == 1 or not address_failure(e): return {addy:failure_row(e) for addy in addys}
+      half = len(addys) // 2
+      return {**geocode_addresses(addys[:half]), **geocode_addresses(addys[half:])}
 
-# takes (lat,lon) or (address)
-def get_intersection(loc_data, apikey):
-  def street_from_address(address):
-    address = address[address.find(" ")+1:]
-    return address
-    
-  square = None
+  # Reports (addresses geocoded, addresses to geocode) after each batch
+  done = 0
+  def geocode_batch(i):
+    nonlocal done
+    rows = geocode_addresses(missing[i*batch_size:(i*batch_size)+batch_size])
+    if progress is not None:
+      with lock:
+        done += len(rows)
+        progress(done, len(missing))
+    return rows
+
+  # Geocode each distinct address once, answering from the cache where possible
+  codes, distinct = addresses_to_MAR(address_data)
+  distinct = distinct.tolist()
+  cached = cache.get_many(distinct) if cache is not None else {}
+  missing = [] if offline else [addy for addy in distinct if addy not in cached]
+
+  session = _MARSession(rate_limit, retries, backoff)
+  batches = range(math.ceil(len(missing) / batch_size))
+  try:
+    if max_workers > 1:
+      with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batch_results = list(executor.map(geocode_batch, batches))
+    else:
+      batch_results = [geocode_batch(i) for i in batches]
+  finally:
+    session.close()
+
+  results = {}
+  for rows in batch_results: results.update(rows)
+  if cache is not None:
+    new_results = {addy:{"lat":r[0], "lon":r[1], "type":r[2]} for addy, r in results.items() if addy in answered}
+    if new_results: cache.put_many(new_results)
+    for addy, r in cached.items():
+      results[addy] = (r["lat"], r["lon"], r["type"], "not found" if np.isnan(r["lat"]) else "ok", "no MAR location" if np.isnan(r["lat"]) else None)
+
+  # Assemble columns once over the distinct addresses, then expand to the input order
+  lat = np.full(len(distinct), np.nan)
+  lon = np.full(len(distinct), np.nan)
+  location_type = np.full(len(distinct), np.nan, dtype=object)
+  status = np.full(len(distinct), "offline" if offline else "error", dtype=object)
+  error = np.full(len(distinct), None, dtype=object)
+  for x, addy in enumerate(distinct):
+    if addy in results:
+      lat[x], lon[x], location_type[x], status[x], error[x] = results[addy]
+  return pd.DataFrame({"lat":lat[codes], "lon":lon[codes], "type":location_type[codes], "status":status[codes], "error":error[codes]})
+
+# Least recently used entries are dropped past maxsize
+class _LRUCache:
+  def __init__(self, maxsize):
+    self.maxsize = maxsize
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+  def get(self, key, default=None):
+    with self.lock:
+      if key not in self.entries: return default
+      self.entries.move_to_end(key)
+      return self.entries[key]
+
+  def put(self, key, value):
+    with self.lock:
+      self.entries[key] = value
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.maxsize:
+        self.entries.popitem(last=False)
+
+# Nearby locations share squares, so square lookups are remembered
+_square_intersections = _LRUCache(4096)
+
+# takes (lat,lon) or (address), returns SSL square or None
+def _location_square(loc_data, apikey, session):
   # Address to SSL - Square
   if type(loc_data) == str:
-    try: 
-      square = get_geodata(loc_data, apikey)["SSL"]
-      if square == None: return np.nan
-      square = square[:square.find(" ")]
-    except Exception as e:
-      print(e)
-      return np.nan
+    address_result = get_geodata(loc_data, apikey, session)[0]
+    # MAR has no location for the address
+    if address_result is None: return None
+    square = address_result["SSL"]
   else:
     # Coords to SSL - Square
-    request = "https://datagate.dc.gov/mar/open/api/v2.0/locations/{},{}/200m?apikey={}".format(loc_data[1],loc_data[0],apikey)
-    try:
-      with urllib.request.urlopen(request) as url:
-          data = json.loads(url.read().decode())
-          if data["Result"] == []: return np.nan
-          square = None
-          for r in range(len(data["Result"])):
-            square = data["Result"][r]["address"]["properties"]["SSL"]
-            if not square == None:
-              break
-          if square == None: return np.nan
-          square = square[:square.find(" ")]
-    except Exception as e:
-      print(e)
-      return np.nan
-  # Square to intersection
-  request = "https://datagate.dc.gov/mar/open/api/v2.0/ssls?square={}&apikey={}".format(square,apikey)
+    request = "{}/locations/{},{}/200m?apikey={}".format(MAR_URL,loc_data[1],loc_data[0],apikey)
+    data = session.get_json(request)
+    square = None
+    for r in range(len(data["Result"])):
+      square = data["Result"][r]["address"]["properties"]["SSL"]
+      if not square == None:
+        break
+  if square == None: return None
+  return square[:square.find(" ")]
+
+# takes SSL square, returns intersection text or np.nan
+def _square_intersection(square, apikey, session):
+  def street_from_address(address):
+    address = address[address.find(" ")+1:]
+    return address
+
+  intersection = _square_intersections.get(square)
+  if intersection is not None:
+    instrumentation.count("square_cache_hits")
+    return intersection
+  instrumentation.count("square_cache_misses")
+  request = "{}/ssls?square={}&apikey={}".format(MAR_URL,square,apikey)
+  data = session.get_json(request)
+  intersection = np.nan
+  # Make sure the two streets are different
+  for i in range(len(data["Result"]["ssls"])):
+    if data["Result"]["ssls"][i]["FullAddress"] == None: continue
+    street1 = street_from_address(data["Result"]["ssls"][i]["FullAddress"])
+    street2 = street_from_address(data["Result"]["ssls"][0]["FullAddress"])
+    if not street1 == street2:
+      intersection = street1 + " AND " + street2
+      break
+  _square_intersections.put(square, intersection)
+  return intersection
+
+# takes (lat,lon) or (address)
+@instrumented
+def get_intersection(loc_data, apikey):
   try:
-    with urllib.request.urlopen(request) as url:
-        data = json.loads(url.read().decode())
-        # Make sure the two streets are different
-        for i in range(len(data["Result"]["ssls"])):
-          if data["Result"]["ssls"][i]["FullAddress"] == None: continue
-          street1 = street_from_address(data["Result"]["ssls"][i]["FullAddress"])
-          street2 = street_from_address(data["Result"]["ssls"][0]["FullAddress"])
-          if not street1 == street2:
-            return street1 + " AND " + street2
+    square = _location_square(loc_data, apikey, _default_session)
+    if square == None: return np.nan
+    # Square to intersection
+    return _square_intersection(square, apikey, _default_session)
   except Exception as e:
     print(e)
     return np.nan
-  return np.nan
+
+# takes [(lat,lon) or (address)]
+@instrumented
+def get_intersections(locations, apikey, max_workers=8, rate_limit=None, retries=0, backoff=0.5):
+  def key(loc_data):
+    return loc_data if type(loc_data) == str else tuple(loc_data)
+
+  def square(loc_data):
+    try: return _location_square(loc_data, apikey, session)
+    except Exception: return None
+
+  def intersection(square):
+    try: return _square_intersection(square, apikey, session)
+    except Exception: return np.nan
+
+  # Look up each distinct location, then each distinct square, once
+  locations = [key(loc_data) for loc_data in locations]
+  distinct = list(dict.fromkeys(locations))
+  session = _MARSession(rate_limit, retries, backoff)
+  try:
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+      squares = dict(zip(distinct, executor.map(square, distinct)))
+      distinct_squares = list(dict.fromkeys(s for s in squares.values() if not s == None))
+      intersections = dict(zip(distinct_squares, executor.map(intersection, distinct_squares)))
+  finally:
+    session.close()
+  return [np.nan if squares[loc_data] == None else intersections[squares[loc_data]] for loc_data in locations]
 
 # Accepts dataframe [[lat, lon]]
 # Returns dataframe [[cluster center (x,y), [points (x,y)]]]
+@instrumented
 def get_clusters(points, cluster_radius_miles=0.5, cluster_number_points=5):
-  def haversine(origin, destination):
-    origin_lat = math.radians(float(origin[0]))
-    origin_lon = math.radians(float(origin[1]))
-    destination_lat = math.radians(float(destination[0]))
-    destination_lon = math.radians(float(destination[1]))
+  import pandas as pd
+  from scipy.spatial import cKDTree
+
+  # Radius of earth in meters, converted to miles
+  r_miles = 6378127 * 0.000621371
+
+  # Vectorized haversine between arrays of coordinates (radians), in miles
+  def haversine(origin_lat, origin_lon, destination_lat, destination_lon):
     lat_delta = destination_lat - origin_lat
     lon_delta = destination_lon - origin_lon
+    a = np.sin(lat_delta / 2) ** 2 + np.cos(origin_lat) * np.cos(destination_lat) * np.sin(lon_delta / 2) ** 2
+    return 2 * np.arcsin(np.sqrt(a)) * r_miles
 
-    # Radius of earth in meters
-    r = 6378127
+  clusters = pd.DataFrame(columns=["center", "points"])
+  if len(points) < cluster_number_points: return clusters
 
-    # Haversine formula
-    a = math.sin(lat_delta / 2) ** 2 + math.cos(origin_lat) * math.cos(destination_lat) * math.sin(lon_delta / 2) ** 2
-    c = 2 * math.asin(math.sqrt(a))
-    meters_traveled = c * r
+  lat = np.radians(points["lat"].to_numpy(dtype=float))
+  lon = np.radians(points["lon"].to_numpy(dtype=float))
+  valid = np.flatnonzero(~np.isnan(lat) & ~np.isnan(lon))
+  if len(valid) < 2: return clusters
+  lat, lon = lat[valid], lon[valid]
 
-    # return in miles
-    return meters_traveled * 0.000621371
+  # Great circle distance is monotonic in chord length, so a KD-tree over unit
+  # vectors finds every point within the radius. Query slightly wide and trim
+  # with haversine so the cutoff matches the original pairwise test. Points
+  # within narrow are inside the radius by far more than rounding error.
+  xyz = np.column_stack((np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)))
+  tree = cKDTree(xyz)
+  chord = 2 * math.sin(min(cluster_radius_miles / r_miles, math.pi) / 2)
+  wide = chord * (1 + 1e-9) + 1e-12
+  narrow = max(chord * (1 - 1e-9) - 1e-12, 0.0)
+
+  # Neighbors within the radius of each point, self excluded
+  def neighbors_of(point_ids):
+    lists = tree.query_ball_point(xyz[point_ids], wide, return_sorted=False)
+    lengths = np.array([len(nb) for nb in lists], dtype=np.int64)
+    nb = np.fromiter(itertools.chain.from_iterable(lists), dtype=np.int32, count=lengths.sum())
+    origin = np.repeat(point_ids, lengths)
+    in_range = (nb != origin) & (haversine(lat[origin], lon[origin], lat[nb], lon[nb]) <= cluster_radius_miles)
+    sizes = np.bincount(np.repeat(np.arange(len(lists)), lengths)[in_range], minlength=len(lists))
+    return np.split(nb[in_range], np.cumsum(sizes)[:-1])
+
+  # Neighbor counts (self included) without building the pairs, queried in
+  # chunks in tree order so nearby points are visited together. Pairs between
+  # narrow and wide may be outside the radius, so chunks with any are recounted
+  # exactly for the points involved.
+  set_sizes = np.empty(len(xyz), dtype=np.int32)
+  for i in range(0, len(xyz), 65536):
+    chunk = tree.indices[i:i + 65536].astype(np.int32)
+    set_sizes[chunk] = tree.query_ball_point(xyz[chunk], wide, return_length=True)
+    narrow_pairs, wide_pairs = cKDTree(xyz[chunk]).count_neighbors(tree, [narrow, wide])
+    if narrow_pairs != wide_pairs:
+      band = chunk[tree.query_ball_point(xyz[chunk], narrow, return_length=True) != set_sizes[chunk]]
+      set_sizes[band] = [len(point_set) + 1 for point_set in neighbors_of(band)]
 
-  clusters = pd.DataFrame(columns=["center", "points"])
-  if len(points) < cluster_number_points: return clusters
-  point_pairs = []
-  # Get distances - BOTTLENECK
-  for i1, p1 in enumerate(points.to_dict("records")):
-    if np.isnan(p1["lat"]): continue
-    for i2, p2 in enumerate(points.to_dict("records")):
-      if np.isnan(p2["lat"]): continue
-      # Combination already tested or self
-      if i1 >= i2: continue
-      p1_coords = [p1["lat"], p1["lon"]]
-      p2_coords = [p2["lat"], p2["lon"]]
-      distance = haversine(p1_coords,p2_coords)
-      # Out of range
-      if np.isnan(distance) or distance > cluster_radius_miles: continue
-      point_pairs.append([i1, i2, p1_coords, p2_coords, distance])
-  
   # Check there are enough total points for clustering
-  if len(point_pairs) < cluster_number_points: return clusters
+  if (set_sizes.sum(dtype=np.int64) - len(set_sizes)) // 2 < cluster_number_points: return clusters
 
-  distances = pd.DataFrame(point_pairs, columns=["p1", "p2", "p1_coords", "p2_coords", "distance"])
+  # Only points paired often enough can form a cluster (self included), largest first
+  candidates = np.flatnonzero((set_sizes >= cluster_number_points) & (set_sizes > 1)).astype(np.int32)
+  if len(candidates) < 1: return clusters
+  candidates = candidates[np.argsort(-set_sizes[candidates], kind="stable")]
 
-  # Remove rows where point is not included in enough pairs to be part of a cluster
-  potential_clusters = []
-  for p in np.unique(distances[["p1", "p2"]].values):
-    point_set = np.unique(distances[(distances["p1"] == p) | (distances["p2"] == p)][["p1", "p2"]].values)
-    if len(point_set) >= cluster_number_points:
-      potential_clusters.append(point_set)
-  
-  if len(potential_clusters) < 1: return clusters
-
-  # Remove lists with items in other lists, favoring size
-  def get_largest_sets(lst):
-    # Test if lists have common items sequentially
-    for x, c in enumerate(lst):
-      common_items = [bool(set(c) & set(i)) if not x == x2 else False for x2, i in enumerate(lst)]
-      # If so, start test over after removing
-      if any(common_items):
-        new_list = [item for x, item in enumerate(lst) if not common_items[x]]
-        return get_largest_sets(new_list)
-    return lst
-
-  potential_clusters.sort(key = lambda x:-len(x))
-  potential_clusters = [c.tolist() for c in potential_clusters]
-  potential_clusters = get_largest_sets(potential_clusters)
+  # Keep sets with no items in previously kept sets, favoring size. Neighbor
+  # sets are built a batch at a time and only for candidates still unclaimed.
+  claimed = np.zeros(len(lat), dtype=bool)
+  kept = []
+  for i in range(0, len(candidates), 256):
+    batch = candidates[i:i + 256]
+    batch = batch[~claimed[batch]]
+    for p, point_set in zip(batch.tolist(), neighbors_of(batch)):
+      if claimed[p] or claimed[point_set].any(): continue
+      claimed[point_set] = True
+      claimed[p] = True
+      kept.append(valid[np.sort(np.append(point_set, p))])
 
   # Accepts [points (x,y)]
   def centeroid(arr):
@@ -183,43 +540,183 @@ def get_clusters(points, cluster_radius_miles=0.5, cluster_number_points=5):
     sum_y = np.sum(arr[:, 1])
     return sum_x/length, sum_y/length
 
-  for cluster in potential_clusters:
-    cluster_set = np.array([[points.iat[point, 0], points.iat[point, 1]] for point in cluster])
-    clusters = clusters.append({"center":centeroid(cluster_set), "points":cluster_set}, ignore_index=True)
+  coords = points.iloc[:, :2].to_numpy()
+  rows = []
+  for cluster in kept:
+    cluster_set = coords[cluster]
+    rows.append({"center":centeroid(cluster_set), "points":cluster_set})
+
+  return pd.DataFrame(rows, columns=["center", "points"])
+
+# Boundary layers: shapefile and the label for each polygon row
+_boundary_layers = {
+  "ward": {"shapefile": "shapefiles/Wards_from_2022.shp", "labels": [8,6,7,2,1,5,3,4]},
+  "nhood": {"shapefile": "shapefiles/DC_Health_Planning_Neighborhoods.shp", "labels": ["SHEPHERD PARK","BARNABY WOODS","BRIGHTWOOD","CHEVY CHASE","LAMOND RIGGS","TENLEYTOWN","FOREST HILLS","BRIGHTWOOD PARK","WOODRIDGE","MICHIGAN PARK","PETWORTH","CATHEDRAL HEIGHTS","DC MEDICAL CENTER","WOODLEY PARK","MOUNT PLEASANT","COLUMBIA HEIGHTS","FORT LINCOLN/GATEWAY","BRENTWOOD","U ST/PLEASANT","ADAMS MORGAN","BLOOMINGDALE","SOUTH COLUMBIA HEIGHTS","GEORGETOWN EAST","GEORGETOWN","TRINIDAD","LOGAN CIRCLE/SHAW","UNION STATION","GWU","CHINATOWN","NATIONAL MALL","KINGMAN PARK","STADIUM ARMORY","FORT DUPONT","HILL EAST","MARSHALL HEIGHTS","SW/WATERFRONT","TWINING","NAYLOR/HILLCREST","NAVAL STATION & AIR FORCE","HISTORIC ANACOSTIA","DOUGLASS","CONGRESS HEIGHTS/SHIPLEY","BELLEVUE","WASHINGTON HIGHLANDS","16th ST HEIGHTS","KENT/PALISADES","EDGEWOOD","EASTLAND GARDENS","LINCOLN HEIGHTS","CAPITOL HILL","SAINT ELIZABETHS"]},
+  "zipcode": {"shapefile": "shapefiles/Zip_Codes.shp", "labels": [20012,20015,20306,20011,20040,20039,20008,20016,20017,20018,20317,20542,20528,20064,20010,20009,20422,20001,20007,20059,20002,20392,20441,20260,20060,20019,20056,20242,20036,20005,20057,20037,20440,20419,20581,20071,20223,20524,20526,20507,20043,20570,20006,20437,20572,20427,20433,20268,20426,20052,20420,20571,20536,20062,20530,20211,20573,20527,20431,20401,20506,20404,20402,20503,20439,20403,20577,20560,20548,20529,20220,20314,20004,20013,20229,20444,20535,20552,20425,20212,20500,20549,20508,20509,20501,20502,20222,20405,20505,20045,20429,20208,20566,20544,20221,20463,20226,20239,20049,20442,20217,20372,20415,20240,20451,20520,20534,20460,20510,20523,20522,20224,20230,20521,20408,20551,20418,20210,20003,20580,20245,20213,20215,20216,20565,20543,20515,20024,20540,20250,20591,20597,20201,20237,20202,20585,20594,20553,20319,20557,20559,20228,20547,20472,20407,20410,20227,20416,20026,20261,20423,20554,20412,20411,20546,20436,20254,20020,20390,20374,20590,20376,20398,20388,20373,20593,20030,20032,20340,20375]},
+  "census": {"shapefile": "shapefiles/Census_Block_Groups_in_2020.shp", "labels": [202,202,202,202,300,300,300,300,400,400,501,501,501,502,502,600,600,600,600,702,702,702,703,703,704,704,802,802,803,803,803,804,804,101,102,102,102,1500,201,201,1200,1301,1301,1301,1301,1303,1303,1303,1303,1304,1304,1304,1304,1401,1401,1402,1402,1402,804,902,902,9902,903,903,9811,904,9901,9901,904,1002,9902,1002,1002,1002,1003,1003,1003,1004,1004,1004,1100,1100,1100,1100,1200,1200,1200,2101,2102,2102,2102,2102,2102,2102,2201,2201,2201,2202,2202,2202,2301,2301,1500,1500,9903,1500,1500,1600,1600,1600,1600,1702,1702,1803,1803,1803,1804,1804,1804,1901,1901,1901,1901,1902,1902,2001,2001,2002,2002,2002,2101,2101,2101,2101,3200,3200,3200,3200,3301,3301,3301,3302,3302,3400,3400,3400,3400,3400,3500,2302,2302,2302,2400,2400,2400,2400,2501,2501,2503,2503,2504,2504,2600,2600,2702,2702,2702,2702,2703,2703,2704,2704,2801,2801,2802,2802,2802,2900,2900,3000,3000,3100,3100,4300,4300,4300,4300,4401,4401,4401,4402,4402,4600,4600,4702,4702,4702,4702,4702,4703,4703,4703,4703,4704,3500,3500,3600,3600,3600,3701,3701,3702,3702,3801,3801,3802,3802,3802,3901,3901,3902,3902,4001,4001,4001,4001,4002,4002,4002,4100,4100,4100,4201,4201,4201,4202,4202,5601,5602,5602,5602,5801,5801,5802,5802,5802,5802,5802,5900,5900,6400,6400,6500,4704,4801,4801,4801,9903,4802,4802,4901,4901,4901,4902,4902,4902,5001,5001,5003,5003,5004,5004,5004,5202,5202,5202,5203,5203,5203,5302,5302,5302,5303,5303,5303,5501,5501,5502,5502,5502,5503,5503,5601,5601,7401,7401,7403,7403,7404,7404,7404,7406,7406,11001,7407,7407,11001,6500,6600,6600,6700,6700,6700,6801,6801,6802,6802,6804,6900,6900,7000,10900,10900,7000,7100,7100,7100,7201,7201,7201,7201,7202,7202,7202,7203,7203,7203,7203,7301,7301,7301,7304,7304,7304,7304,7604,7604,9301,7604,7604,7605,7605,7605,7605,9000,7703,7703,7703,7703,7407,7408,9102,7408,7409,7409,7409,7502,7502,7502,7503,9302,7503,7504,8702,7504,7601,7601,9201,7601,7601,7601,7603,7603,8702,7603,7603,7708,7709,7901,7901,7901,7709,7803,7803,7901,7903,8001,8001,7803,7803,7804,8702,8001,8002,8002,8100,7804,7804,8100,8100,8200,8200,7806,7806,8200,8200,8301,8301,7807,7807,8302,8302,8302,8402,7808,7808,7707,7707,7808,7809,7809,7707,7708,8402,8410,8701,8701,9000,9102,9400,9400,8802,8802,8802,8802,9102,9102,9400,9400,8803,8803,9201,9203,9602,9503,9503,8804,8804,8903,8903,11002,9203,9204,9204,9503,9504,9504,8903,8904,8904,9802,11001,9301,9301,9301,9505,9505,9508,8904,9000,9803,9803,9810,9810,11002,9508,9509,9602,9602,9603,9803,9804,9811,9811,9509,9509,9603,9603,9604,9604,9804,9807,9505,9507,9510,9510,9700,9700,9700,9807,9807,9508,9508,9510,9511,9601,9801,9802,10601,10601,10602,10602,10602,10602,10603,10603,10603,10700,10700,10800,10800,10800,10800,10800,10800,9904,9904,9904,9905,9905,9905,9906,9907,9907,10100,10100,10100,10201,10201,10201,10202,10202,10202,10202,10202,10202,10300,10300,10300,10400,10400,10400,10500,10500,10500,10500,10500,11100,11100,11100,980000]}
+}
+_boundaries = {}
+_boundaries_lock = threading.Lock()
+
+# Loads a boundary layer once per process with prepared polygons and labels
+def _get_boundaries(layer):
+  import geopandas as gpd, pkg_resources, shapely
+  if layer not in _boundaries:
+    with _boundaries_lock:
+      if layer not in _boundaries:
+        if layer not in _boundary_layers:
+          raise ValueError("Unknown boundary layer: {}".format(layer))
+        area = gpd.read_file(pkg_resources.resource_filename('dcgeotools', _boundary_layers[layer]["shapefile"]))
+        shapely.prepare(area.geometry.values)
+        # Position of each polygon in the order a polygon tree visits them,
+        # which is the order sjoin lists polygons matching the same point
+        visited = shapely.STRtree(area.geometry.values).query(shapely.box(*shapely.total_bounds(area.geometry.values)))
+        tree_order = np.empty(len(area), dtype=np.int64)
+        tree_order[visited] = np.arange(len(visited))
+        _boundaries[layer] = (area, np.array(_boundary_layers[layer]["labels"]), tree_order)
+  return _boundaries[layer]
+
+def _geo_points(points):
+  import geopandas as gpd
+  return gpd.GeoDataFrame(points, geometry = gpd.points_from_xy(points["lon"].to_list(), points["lat"].to_list()))
+
+# Matches points to the polygons of a layer, ordered by point then polygon
+# index, or by point then polygon tree order as sjoin does. Querying a tree of
+# the points with prepared polygons is much faster than testing each point
+# against the polygon tree; "covers" equals "intersects" for points, so
+# matches are the same as sjoin.
+def _match_layer(point_tree, layer, sjoin_order=False):
+  area, labels, tree_order = _get_boundaries(layer)
+  area_idx, point_idx = point_tree.query(area.geometry.values, predicate="covers")
+  order = np.lexsort((tree_order[area_idx] if sjoin_order else area_idx, point_idx))
+  return point_idx[order], labels[area_idx[order]]
 
-  return clusters
+def _tag_layer(points, layer):
+  import shapely
+  geo_points = _geo_points(points)
+  point_idx, labels = _match_layer(shapely.STRtree(geo_points.geometry.values), layer, sjoin_order=True)
+  results = geo_points[["geometry"]].iloc[point_idx]
+  results[layer] = labels
+  return results
 
 # takes dataframe[[lon,lat]]
+@instrumented
 def get_ward(points):
-  geo_points = gpd.GeoDataFrame(points, geometry = gpd.points_from_xy(points["lon"].to_list(), points["lat"].to_list()))
-  w_area = gpd.read_file(pkg_resources.resource_filename('dcgeotools', 'shapefiles/Wards_from_2022.shp'))
-  w_results = gpd.sjoin(geo_points, w_area)[["geometry", "index_right"]].rename(columns={"index_right":"ward"})
-  w_results["ward"] = w_results["ward"].replace([0,1,2,3,4,5,6,7],[8,6,7,2,1,5,3,4])
-  return w_results
+  return _tag_layer(points, "ward")
 
 # takes dataframe[[lon,lat]]
+@instrumented
 def get_nhood(points):
-  geo_points = gpd.GeoDataFrame(points, geometry = gpd.points_from_xy(points["lon"].to_list(), points["lat"].to_list()))
-  ordered_dc_neighborhoods = ["SHEPHERD PARK","BARNABY WOODS","BRIGHTWOOD","CHEVY CHASE","LAMOND RIGGS","TENLEYTOWN","FOREST HILLS","BRIGHTWOOD PARK","WOODRIDGE","MICHIGAN PARK","PETWORTH","CATHEDRAL HEIGHTS","DC MEDICAL CENTER","WOODLEY PARK","MOUNT PLEASANT","COLUMBIA HEIGHTS","FORT LINCOLN/GATEWAY","BRENTWOOD","U ST/PLEASANT","ADAMS MORGAN","BLOOMINGDALE","SOUTH COLUMBIA HEIGHTS","GEORGETOWN EAST","GEORGETOWN","TRINIDAD","LOGAN CIRCLE/SHAW","UNION STATION","GWU","CHINATOWN","NATIONAL MALL","KINGMAN PARK","STADIUM ARMORY","FORT DUPONT","HILL EAST","MARSHALL HEIGHTS","SW/WATERFRONT","TWINING","NAYLOR/HILLCREST","NAVAL STATION & AIR FORCE","HISTORIC ANACOSTIA","DOUGLASS","CONGRESS HEIGHTS/SHIPLEY","BELLEVUE","WASHINGTON HIGHLANDS","16th ST HEIGHTS","KENT/PALISADES","EDGEWOOD","EASTLAND GARDENS","LINCOLN HEIGHTS","CAPITOL HILL","SAINT ELIZABETHS"]
-  n_area = gpd.read_file(pkg_resources.resource_filename('dcgeotools', 'shapefiles/DC_Health_Planning_Neighborhoods.shp'))
-  n_results = gpd.sjoin(geo_points, n_area)[["geometry","index_right"]].rename(columns={"index_right":"nhood"})
-  n_results["nhood"] = [ordered_dc_neighborhoods[i] for i in n_results["nhood"].to_list()]
-  return n_results
+  return _tag_layer(points, "nhood")
 
 # takes dataframe[[lon,lat]]
+@instrumented
 def get_zipcode(points):
-  geo_points = gpd.GeoDataFrame(points, geometry = gpd.points_from_xy(points["lon"].to_list(), points["lat"].to_list()))
-  z_area = gpd.read_file(pkg_resources.resource_filename('dcgeotools', 'shapefiles/Zip_Codes.shp'))
-  z_results = gpd.sjoin(geo_points, z_area)[["geometry", "index_right"]].rename(columns={"index_right":"zipcode"})
-  zipcodes = [20012,20015,20306,20011,20040,20039,20008,20016,20017,20018,20317,20542,20528,20064,20010,20009,20422,20001,20007,20059,20002,20392,20441,20260,20060,20019,20056,20242,20036,20005,20057,20037,20440,20419,20581,20071,20223,20524,20526,20507,20043,20570,20006,20437,20572,20427,20433,20268,20426,20052,20420,20571,20536,20062,20530,20211,20573,20527,20431,20401,20506,20404,20402,20503,20439,20403,20577,20560,20548,20529,20220,20314,20004,20013,20229,20444,20535,20552,20425,20212,20500,20549,20508,20509,20501,20502,20222,20405,20505,20045,20429,20208,20566,20544,20221,20463,20226,20239,20049,20442,20217,20372,20415,20240,20451,20520,20534,20460,20510,20523,20522,20224,20230,20521,20408,20551,20418,20210,20003,20580,20245,20213,20215,20216,20565,20543,20515,20024,20540,20250,20591,20597,20201,20237,20202,20585,20594,20553,20319,20557,20559,20228,20547,20472,20407,20410,20227,20416,20026,20261,20423,20554,20412,20411,20546,20436,20254,20020,20390,20374,20590,20376,20398,20388,20373,20593,20030,20032,20340,20375]
-  z_results["zipcode"] = z_results["zipcode"].apply(lambda x: zipcodes[x])
-  return z_results
+  return _tag_layer(points, "zipcode")
 
 # takes dataframe[[lon,lat]]
+@instrumented
 def get_census(points):
-  geo_points = gpd.GeoDataFrame(points, geometry = gpd.points_from_xy(points["lon"].to_list(), points["lat"].to_list()))
-  c_area = gpd.read_file(pkg_resources.resource_filename('dcgeotools', 'shapefiles/Census_Block_Groups_in_2020.shp'))
-  c_results = gpd.sjoin(geo_points, c_area)[["geometry", "index_right"]].rename(columns={"index_right":"census"})
-  census = [202,202,202,202,300,300,300,300,400,400,501,501,501,502,502,600,600,600,600,702,702,702,703,703,704,704,802,802,803,803,803,804,804,101,102,102,102,1500,201,201,1200,1301,1301,1301,1301,1303,1303,1303,1303,1304,1304,1304,1304,1401,1401,1402,1402,1402,804,902,902,9902,903,903,9811,904,9901,9901,904,1002,9902,1002,1002,1002,1003,1003,1003,1004,1004,1004,1100,1100,1100,1100,1200,1200,1200,2101,2102,2102,2102,2102,2102,2102,2201,2201,2201,2202,2202,2202,2301,2301,1500,1500,9903,1500,1500,1600,1600,1600,1600,1702,1702,1803,1803,1803,1804,1804,1804,1901,1901,1901,1901,1902,1902,2001,2001,2002,2002,2002,2101,2101,2101,2101,3200,3200,3200,3200,3301,3301,3301,3302,3302,3400,3400,3400,3400,3400,3500,2302,2302,2302,2400,2400,2400,2400,2501,2501,2503,2503,2504,2504,2600,2600,2702,2702,2702,2702,2703,2703,2704,2704,2801,2801,2802,2802,2802,2900,2900,3000,3000,3100,3100,4300,4300,4300,4300,4401,4401,4401,4402,4402,4600,4600,4702,4702,4702,4702,4702,4703,4703,4703,4703,4704,3500,3500,3600,3600,3600,3701,3701,3702,3702,3801,3801,3802,3802,3802,3901,3901,3902,3902,4001,4001,4001,4001,4002,4002,4002,4100,4100,4100,4201,4201,4201,4202,4202,5601,5602,5602,5602,5801,5801,5802,5802,5802,5802,5802,5900,5900,6400,6400,6500,4704,4801,4801,4801,9903,4802,4802,4901,4901,4901,4902,4902,4902,5001,5001,5003,5003,5004,5004,5004,5202,5202,5202,5203,5203,5203,5302,5302,5302,5303,5303,5303,5501,5501,5502,5502,5502,5503,5503,5601,5601,7401,7401,7403,7403,7404,7404,7404,7406,7406,11001,7407,7407,11001,6500,6600,6600,6700,6700,6700,6801,6801,6802,6802,6804,6900,6900,7000,10900,10900,7000,7100,7100,7100,7201,7201,7201,7201,7202,7202,7202,7203,7203,7203,7203,7301,7301,7301,7304,7304,7304,7304,7604,7604,9301,7604,7604,7605,7605,7605,7605,9000,7703,7703,7703,7703,7407,7408,9102,7408,7409,7409,7409,7502,7502,7502,7503,9302,7503,7504,8702,7504,7601,7601,9201,7601,7601,7601,7603,7603,8702,7603,7603,7708,7709,7901,7901,7901,7709,7803,7803,7901,7903,8001,8001,7803,7803,7804,8702,8001,8002,8002,8100,7804,7804,8100,8100,8200,8200,7806,7806,8200,8200,8301,8301,7807,7807,8302,8302,8302,8402,7808,7808,7707,7707,7808,7809,7809,7707,7708,8402,8410,8701,8701,9000,9102,9400,9400,8802,8802,8802,8802,9102,9102,9400,9400,8803,8803,9201,9203,9602,9503,9503,8804,8804,8903,8903,11002,9203,9204,9204,9503,9504,9504,8903,8904,8904,9802,11001,9301,9301,9301,9505,9505,9508,8904,9000,9803,9803,9810,9810,11002,9508,9509,9602,9602,9603,9803,9804,9811,9811,9509,9509,9603,9603,9604,9604,9804,9807,9505,9507,9510,9510,9700,9700,9700,9807,9807,9508,9508,9510,9511,9601,9801,9802,10601,10601,10602,10602,10602,10602,10603,10603,10603,10700,10700,10800,10800,10800,10800,10800,10800,9904,9904,9904,9905,9905,9905,9906,9907,9907,10100,10100,10100,10201,10201,10201,10202,10202,10202,10202,10202,10202,10300,10300,10300,10400,10400,10400,10500,10500,10500,10500,10500,11100,11100,11100,980000]
-  c_results["census"] = c_results["census"].apply(lambda x: census[x])
-  return c_results
+  return _tag_layer(points, "census")
+
+# takes dataframe[[lon,lat]]
+# Points outside a layer get NaN; points on a shared edge take the first polygon
+@instrumented
+def get_regions(points, layers=("ward", "nhood", "zipcode", "census")):
+  import pandas as pd, shapely
+  geo_points = _geo_points(points)
+  point_tree = shapely.STRtree(geo_points.geometry.values)
+  results = geo_points[["geometry"]].copy()
+  for layer in layers:
+    point_idx, labels = _match_layer(point_tree, layer)
+    point_idx, first = np.unique(point_idx, return_index=True)
+    column = np.full(len(geo_points), np.nan, dtype=object)
+    column[point_idx] = labels[first]
+    results[layer] = pd.Series(column, index=results.index).infer_objects()
+  return results
+
+# Reads DataFrame chunks from a CSV or Parquet file or an iterable of addresses
+def _address_chunks(source, column, chunk_size):
+  import pandas as pd
+  if isinstance(source, (str, os.PathLike)):
+    if str(source).endswith(".parquet"):
+      import pyarrow.parquet as pq
+      for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size):
+        yield batch.to_pandas()
+    else:
+      yield from pd.read_csv(source, chunksize=chunk_size, dtype={column:object})
+  else:
+    iterator = iter(source)
+    while True:
+      chunk = list(itertools.islice(iterator, chunk_size))
+      if chunk == []: return
+      yield pd.DataFrame({column:chunk})
+
+# Writes via a temporary file so a crash never leaves a partial file behind
+def _write_checkpoint(checkpoint, state):
+  with open(checkpoint + ".tmp", "w") as f:
+    json.dump(state, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(checkpoint + ".tmp", checkpoint)
+
+# takes iterable of addresses or CSV/Parquet file with an address column
+# Writes input columns with geocode results and regions to a CSV file, or to a
+# directory of Parquet part files when output ends in .parquet
+@instrumented
+def geocode_stream(source, output, apikey, column="address", chunk_size=10000, checkpoint=None, layers=("ward", "nhood", "zipcode", "census"), progress=None, **geocode_options):
+  import pandas as pd
+  parquet = str(output).endswith(".parquet")
+  state = {"chunks":0, "rows":0, "output_bytes":0, "chunk_size":chunk_size}
+  if checkpoint is not None and os.path.exists(checkpoint):
+    with open(checkpoint) as f:
+      state = json.load(f)
+    # Completed chunks are skipped by count, which only lines up with the same chunk size
+    if state.get("chunk_size") != chunk_size:
+      raise ValueError("checkpoint {} was written with chunk_size {}, not {}".format(checkpoint, state.get("chunk_size"), chunk_size))
+
+  # Output of the completed chunks must still be there to resume
+  if parquet:
+    os.makedirs(output, exist_ok=True)
+    parts = {int(part[5:10]) for part in os.listdir(output) if part.startswith("part-")}
+    missing = not parts.issuperset(range(state["chunks"]))
+  else:
+    missing = (os.path.getsize(output) if os.path.exists(output) else 0) < state["output_bytes"]
+  if missing:
+    raise ValueError("output {} is missing chunks recorded in checkpoint {}, remove the checkpoint to start over".format(output, checkpoint))
+
+  # Drop output from any chunk written after the last checkpoint
+  if parquet:
+    for part in os.listdir(output):
+      if part.startswith("part-") and int(part[5:10]) >= state["chunks"]:
+        os.remove(os.path.join(output, part))
+  elif os.path.exists(output):
+    with open(output, "a+b") as f:
+      f.truncate(state["output_bytes"])
+
+  for i, chunk in enumerate(_address_chunks(source, column, chunk_size)):
+    # Completed in an earlier run
+    if i < state["chunks"]: continue
+    chunk = chunk.reset_index(drop=True)
+    results = pd.concat([chunk, geocode(chunk[column].tolist(), apikey, **geocode_options)], axis=1)
+    located = results["lat"].notna() & results["lon"].notna()
+    if layers:
+      regions = get_regions(results.loc[located, ["lat", "lon"]], layers)
+      for layer in layers:
+        results[layer] = regions[layer].reindex(results.index)
+
+    if parquet:
+      # Keep part schemas consistent when a chunk has only missing values in a column
+      results = results.astype({c:("string" if c in ("type", "status", "error", "nhood") else "float64") for c in results.columns[len(chunk.columns):]})
+      results.to_parquet(os.path.join(output, "part-{:05d}.parquet".format(i)), index=False)
+    else:
+      with open(output, "ab") as f:
+        results.to_csv(f, header=state["output_bytes"] == 0, index=False)
+        f.flush()
+        os.fsync(f.fileno())
+        state["output_bytes"] = f.tell()
+    state["chunks"] = i + 1
+    state["rows"] += len(results)
+    if checkpoint is not None: _write_checkpoint(checkpoint, state)
+    if progress is not None: progress(state["rows"], None)
+  return {"chunks":state["chunks"], "rows":state["rows"]}
@@ -0,0 +1,202 @@
+import json, os
+from fractions import Fraction
+import numpy as np
+from dcgeotools.instrumentation import instrumented
+
+# Precompiled region lookup. A uniform grid covers DC; cells inside a single
+# polygon store its index, cells crossed by a boundary point to candidate
+# polygons tested exactly with a crossing-number test against the polygon
+# edges spanning the cell's row. Lookups need only NumPy, the build step uses
+# the bundled shapefiles through geopandas.
+GRID_PATH = os.path.join(os.path.dirname(__file__), "shapefiles", "grid")
+
+_EMPTY = -1
+# Boundary cells store -2 - (position in the candidate lists)
+_BOUNDARY = -2
+
+_grids = {}
+
+# Error bound of the floating point orientation determinant (Shewchuk)
+_orientation_error = (3 + 16 * 2.0 ** -53) * 2.0 ** -53
+
+# Compiles the bundled boundary layers into .npy files under path
+def build_grid(path=GRID_PATH, cells=512):
+  import shapely
+  from dcgeotools import _boundary_layers, _get_boundaries
+
+  layers = list(_boundary_layers)
+  areas = {layer:_get_boundaries(layer)[0].geometry.to_numpy() for layer in layers}
+
+  # Grid over all layers with a margin so every polygon is strictly inside
+  bounds = np.array([shapely.total_bounds(areas[layer]) for layer in layers])
+  x0, y0 = bounds[:, 0].min() - 1e-6, bounds[:, 1].min() - 1e-6
+  x1, y1 = bounds[:, 2].max() + 1e-6, bounds[:, 3].max() + 1e-6
+  dx, dy = (x1 - x0) / cells, (y1 - y0) / cells
+
+  # Boxes are padded so a point rounded into a neighboring cell is still covered
+  pad = 1e-9
+  cell_y, cell_x = np.divmod(np.arange(cells * cells), cells)
+  boxes = shapely.box(x0 + cell_x * dx - pad, y0 + cell_y * dy - pad, x0 + (cell_x + 1) * dx + pad, y0 + (cell_y + 1) * dy + pad)
+
+  os.makedirs(path, exist_ok=True)
+  for layer in layers:
+    geoms = areas[layer]
+    box_idx, poly_idx = shapely.STRtree(geoms).query(boxes, predicate="intersects")
+    order = np.lexsort((poly_idx, box_idx))
+    box_idx, poly_idx = box_idx[order], poly_idx[order]
+    counts = np.bincount(box_idx, minlength=len(boxes))
+
+    # Cells touched by one polygon that covers them are interior
+    grid = np.full(len(boxes), _EMPTY, dtype=np.int32)
+    single = counts[box_idx] == 1
+    covered = single.copy()
+    covered[single] = shapely.covers(geoms[poly_idx[single]], boxes[box_idx[single]])
+    grid[box_idx[covered]] = poly_idx[covered]
+
+    # Every other touched cell keeps its candidate polygons, lowest index first
+    boundary = ~covered
+    boundary_cells, first = np.unique(box_idx[boundary], return_index=True)
+    grid[boundary_cells] = _BOUNDARY - np.arange(len(boundary_cells))
+    candidate_ptr = np.append(first, boundary.sum()).astype(np.int64)
+    candidates = poly_idx[boundary].astype(np.int32)
+
+    # Polygon edges grouped into strips by grid row and polygon
+    parts, part_poly = shapely.get_parts(geoms, return_index=True)
+    rings, ring_part = shapely.get_rings(parts, return_index=True)
+    coords, coord_ring = shapely.get_coordinates(rings, return_index=True)
+    same_ring = coord_ring[:-1] == coord_ring[1:]
+    a, b = coords[:-1][same_ring], coords[1:][same_ring]
+    edge_poly = part_poly[ring_part[coord_ring[:-1][same_ring]]]
+    row0 = np.floor((np.minimum(a[:, 1], b[:, 1]) - y0) / dy).astype(np.int64)
+    row1 = np.floor((np.maximum(a[:, 1], b[:, 1]) - y0) / dy).astype(np.int64)
+    spans = row1 - row0 + 1
+    edge_idx = np.repeat(np.arange(len(a)), spans)
+    rows = row0[edge_idx] + np.arange(len(edge_idx)) - np.repeat(np.cumsum(spans) - spans, spans)
+    keys = rows * len(geoms) + edge_poly[edge_idx]
+    order = np.argsort(keys, kind="stable")
+    keys, edge_idx = keys[order], edge_idx[order]
+    strip_keys, strip_start = np.unique(keys, return_index=True)
+
+    arrays = {
+      "cells":grid.reshape(cells, cells),
+      "candidate_ptr":candidate_ptr,
+      "candidates":candidates,
+      "strip_keys":strip_keys,
+      "strip_ptr":np.append(strip_start, len(keys)).astype(np.int64),
+      "edges":np.column_stack((a[edge_idx], b[edge_idx])),
+      "labels":np.array(_boundary_layers[layer]["labels"])
+    }
+    for name, array in arrays.items():
+      np.save(os.path.join(path, "{}.{}.npy".format(layer, name)), array)
+
+  with open(os.path.join(path, "grid.json"), "w") as f:
+    json.dump({"bounds":[x0, y0, x1, y1], "cells":cells, "layers":{layer:len(areas[layer]) for layer in layers}}, f)
+
+# Memory-maps a compiled layer once per process
+def _load_layer(layer, path=GRID_PATH):
+  if (path, layer) not in _grids:
+    with open(os.path.join(path, "grid.json")) as f:
+      meta = json.load(f)
+    if layer not in meta["layers"]:
+      raise ValueError("Unknown boundary layer: {}".format(layer))
+    arrays = {name:np.load(os.path.join(path, "{}.{}.npy".format(layer, name)), mmap_mode="r") for name in ["cells", "candidate_ptr", "candidates", "strip_keys", "strip_ptr", "edges", "labels"]}
+    _grids[(path, layer)] = (meta, arrays)
+  return _grids[(path, layer)]
+
+# Sign of the orientation of p against edge a-b. Results within floating point
+# error of zero are recomputed exactly so points on or next to an edge agree
+# with the robust predicates shapely uses.
+def _orientation(ax, ay, bx, by, px, py):
+  left = (ax - px) * (by - py)
+  right = (ay - py) * (bx - px)
+  det = left - right
+  side = np.sign(det).astype(np.int8)
+  bound = _orientation_error * (np.abs(left) + np.abs(right))
+  uncertain = np.flatnonzero((np.abs(det) <= bound) & (bound > 0))
+  for i in uncertain:
+    a_x, a_y, b_x, b_y, p_x, p_y = (Fraction(float(v[i])) for v in (ax, ay, bx, by, px, py))
+    exact = (a_x - p_x) * (b_y - p_y) - (a_y - p_y) * (b_x - p_x)
+    side[i] = (exact > 0) - (exact < 0)
+  return side
+
+# Index of the first polygon covering each point, -1 where none does
+def _lookup_layer(lat, lon, layer, path=GRID_PATH, chunk_size=1000000):
+  meta, arrays = _load_layer(layer, path)
+  x0, y0, x1, y1 = meta["bounds"]
+  cells = meta["cells"]
+  n_polys = meta["layers"][layer]
+  dx, dy = (x1 - x0) / cells, (y1 - y0) / cells
+
+  result = np.full(len(lat), _EMPTY, dtype=np.int64)
+  with np.errstate(invalid="ignore"):
+    col = np.floor((lon - x0) / dx)
+    row = np.floor((lat - y0) / dy)
+    inside = (col >= 0) & (col < cells) & (row >= 0) & (row < cells)
+  points = np.flatnonzero(inside)
+  row, col = row[points].astype(np.int64), col[points].astype(np.int64)
+  value = arrays["cells"][row, col]
+  result[points] = np.where(value >= 0, value, _EMPTY)
+
+  # Exact test for points in boundary cells, one (point, candidate) pair at a time
+  boundary = value <= _BOUNDARY
+  points, row = points[boundary], row[boundary]
+  slot = _BOUNDARY - value[boundary]
+  start, stop = arrays["candidate_ptr"][slot], arrays["candidate_ptr"][slot + 1]
+  counts = stop - start
+  pair_point = np.repeat(np.arange(len(points)), counts)
+  pair_candidate = arrays["candidates"][np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())]
+  pair_key = row[pair_point] * n_polys + pair_candidate
+  strip = np.searchsorted(arrays["strip_keys"], pair_key)
+  strip = np.minimum(strip, len(arrays["strip_keys"]) - 1)
+  has_strip = arrays["strip_keys"][strip] == pair_key
+  edge_start = np.where(has_strip, arrays["strip_ptr"][strip], 0)
+  edge_count = np.where(has_strip, arrays["strip_ptr"][strip + 1] - edge_start, 0)
+
+  # Chunks of pairs with about chunk_size edge tests each to bound memory
+  covered = np.zeros(len(pair_point), dtype=bool)
+  edge_ends = np.cumsum(edge_count)
+  p0 = 0
+  while p0 < len(pair_point):
+    p1 = max(p0 + 1, int(np.searchsorted(edge_ends, edge_ends[p0] - edge_count[p0] + chunk_size, side="right")))
+    n = edge_count[p0:p1]
+    pair = np.repeat(np.arange(p0, p1), n)
+    edges = arrays["edges"][np.repeat(edge_start[p0:p1] - np.cumsum(n) + n, n) + np.arange(n.sum())]
+    px, py = lon[points[pair_point[pair]]], lat[points[pair_point[pair]]]
+    ax, ay, bx, by = edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+    side = _orientation(ax, ay, bx, by, px, py)
+    # Crossing number of a ray to the right, half-open in y
+    spans = (ay > py) != (by > py)
+    crossing = spans & (side * np.sign(by - ay) > 0)
+    # Points on an edge are covered
+    on_edge = (side == 0) & (np.minimum(ax, bx) <= px) & (px <= np.maximum(ax, bx)) & (np.minimum(ay, by) <= py) & (py <= np.maximum(ay, by))
+    crossings = np.bincount(pair - p0, weights=crossing, minlength=p1 - p0)
+    touches = np.bincount(pair - p0, weights=on_edge, minlength=p1 - p0)
+    covered[p0:p1] = (crossings % 2 == 1) | (touches > 0)
+    p0 = p1
+
+  # Candidates are in polygon order, so the first covering one wins
+  hit_point, first = np.unique(pair_point[covered], return_index=True)
+  result[points[hit_point]] = pair_candidate[covered][first]
+  return result
+
+# takes arrays of lat and lon
+# Returns {layer: labels} with NaN for points outside the layer, matching get_regions
+@instrumented
+def lookup_regions(lat, lon, layers=("ward", "nhood", "zipcode", "census"), path=GRID_PATH):
+  lat = np.asarray(lat, dtype=float)
+  lon = np.asarray(lon, dtype=float)
+  regions = {}
+  for layer in layers:
+    labels = _load_layer(layer, path)[1]["labels"]
+    idx = _lookup_layer(lat, lon, layer, path)
+    found = idx >= 0
+    if labels.dtype.kind in "iuf":
+      column = np.full(len(idx), np.nan)
+    else:
+      column = np.full(len(idx), np.nan, dtype=object)
+    column[found] = labels[idx[found]].tolist()
+    regions[layer] = column
+  return regions
+
+if __name__ == "__main__":
+  build_grid()
@@ -0,0 +1,66 @@
+import functools, json, threading, time
+
+# Opt-in hot path metrics: wall time per function and counters such as MAR
+# requests, bytes transferred and cache hits. Nothing is recorded until
+# enable_instrumentation() is called.
+class Instrumentation:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.timings = {}
+    self.counters = {}
+
+  def add_time(self, name, seconds):
+    with self.lock:
+      timing = self.timings.setdefault(name, {"calls":0, "seconds":0.0, "max_seconds":0.0})
+      timing["calls"] += 1
+      timing["seconds"] += seconds
+      timing["max_seconds"] = max(timing["max_seconds"], seconds)
+
+  def count(self, name, n=1):
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def reset(self):
+    with self.lock:
+      self.timings = {}
+      self.counters = {}
+
+  def to_dict(self):
+    with self.lock:
+      return {"timings":{name:dict(timing) for name, timing in self.timings.items()}, "counters":dict(self.counters)}
+
+  def to_json(self, **kwargs):
+    return json.dumps(self.to_dict(), **kwargs)
+
+_active = None
+
+# Starts recording into a new Instrumentation, or the one given, and returns it
+def enable_instrumentation(instrumentation=None):
+  global _active
+  _active = instrumentation if instrumentation is not None else Instrumentation()
+  return _active
+
+# Stops recording and returns what was recorded
+def disable_instrumentation():
+  global _active
+  instrumentation, _active = _active, None
+  return instrumentation
+
+def get_instrumentation():
+  return _active
+
+def count(name, n=1):
+  if _active is not None: _active.count(name, n)
+
+# Records wall time of each call while instrumentation is enabled
+def instrumented(func):
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    instrumentation = _active
+    if instrumentation is None: return func(*args, **kwargs)
+    start = time.perf_counter()
+    try:
+      return func(*args, **kwargs)
+    finally:
+      instrumentation.add_time(func.__name__, time.perf_counter() - start)
+  return wrapper
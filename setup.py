@@ -17,7 +17,8 @@ setup(name="dcgeotools",
           "rtree",
           "pandas",
           "geopandas",
-          "numpy"
+          "numpy",
+          "scipy"
       ],
       test_suite='nose.collector',
       tests_require=['nose'],
@@ -0,0 +1,30 @@
+import unittest
+import numpy as np
+import dcgeotools
+
+# Fragments that exercise each step of address_to_MAR and how they interact
+fragments = [" ", "  ", " apt", " APT", "#", ".", ",", "?", "-", "/", "\\\\", "blk", "BLK", "block", "b", "l", "o", "f", "k", "c", "of", "Of",
+  ", washington dc", ", WASHINGTON DC", ",, washington dc", ", washington", "1200", "st", "NW", "SE", "\n", "\t", "é", "É", "ß", "İ"]
+
+def corpus(n, seed=0):
+  rng = np.random.default_rng(seed)
+  addresses = ["".join(rng.choice(fragments, rng.integers(1, 12))) for i in range(n)]
+  addresses += ["1200 Main St NW", "12 Elm Ave. SE, Washington DC", "500 Oak Pl NE Apt 3", "6 Pine Rd #4", "100 Blk of 5th St-NW", "no-space", "", float("nan"), 12.5]
+  # Repeats, so distinct addresses are factored
+  return addresses + addresses[:n // 4]
+
+class TestAddressesToMAR(unittest.TestCase):
+  def test_matches_address_to_MAR(self):
+    addresses = corpus(25000)
+    codes, uniques = dcgeotools.addresses_to_MAR(addresses)
+    self.assertEqual(len(codes), len(addresses))
+    for address, mar in zip(addresses, uniques[codes]):
+      self.assertEqual(mar, dcgeotools.address_to_MAR(address), repr(address))
+
+  def test_uniques_are_distinct(self):
+    codes, uniques = dcgeotools.addresses_to_MAR(["1 Main St", "1 main st.", "1 MAIN ST, Washington DC", "2 Main St"])
+    self.assertEqual(codes.tolist(), [0, 0, 0, 1])
+    self.assertEqual(uniques.tolist(), ["1 main st", "2 main st"])
+
+if __name__ == "__main__":
+  unittest.main()
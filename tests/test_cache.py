@@ -0,0 +1,94 @@
+import os, tempfile, unittest
+from unittest import mock
+import numpy as np
+import dcgeotools
+from test_geocode import MockMAR, MockMARTestCase, addresses, expected
+
+class CacheTestCase(MockMARTestCase):
+  def setUp(self):
+    super().setUp()
+    self.tmp = tempfile.TemporaryDirectory()
+    self.path = os.path.join(self.tmp.name, "cache.db")
+
+  def tearDown(self):
+    super().tearDown()
+    self.tmp.cleanup()
+
+  def cache(self, **options):
+    cache = dcgeotools.GeocodeCache(self.path, **options)
+    self.addCleanup(cache.close)
+    return cache
+
+class TestGeocodeCache(CacheTestCase):
+  def test_second_run_answered_from_cache(self):
+    cache = self.cache()
+    with MockMAR() as mar:
+      first = self.geocode(mar, addresses, batch_size=10, cache=cache)
+      second = self.geocode(mar, addresses, batch_size=10, cache=cache)
+    self.assertNotIn("mar_requests", self.metrics.counters)
+    self.assertTrue(first.equals(second))
+    distinct = len(set(dcgeotools.address_to_MAR(a) for a in addresses))
+    self.assertEqual(cache.stats(), {"hits":distinct, "misses":distinct, "evictions":0, "entries":distinct})
+    self.assertEqual(self.metrics.counters["geocode_cache_hits"], distinct)
+
+  def test_negative_result_round_trip(self):
+    cache = self.cache()
+    # Sent alone, the mock answers the unknown address without a location
+    with MockMAR() as mar:
+      first = self.geocode(mar, ["zzz unknown place", "1 Main St NW"], batch_size=1, cache=cache)
+    self.assertEqual(len(cache), 2)
+    offline = dcgeotools.geocode(["zzz unknown place", "1 Main St NW"], "test", cache=cache, offline=True)
+    self.assertEqual(offline["status"].tolist(), ["not found", "ok"])
+    self.assertTrue(np.isnan(offline["lat"][0]))
+    self.assertEqual((offline["lat"][1], offline["lon"][1]), expected("1 Main St NW"))
+    self.assertEqual(first["status"].tolist(), offline["status"].tolist())
+
+  def test_failures_are_not_cached(self):
+    cache = self.cache()
+    with MockMAR(error_rate=1.0) as mar:
+      result = self.geocode(mar, addresses[:40], batch_size=40, cache=cache)
+    self.assertTrue((result["status"] == "error").all())
+    # Addresses MAR rejected are not known to have no location
+    with MockMAR(fail_status=400) as mar:
+      result = self.geocode(mar, addresses[:8], batch_size=8, cache=cache)
+    self.assertTrue((result["status"] == "not found").all())
+    self.assertEqual(len(cache), 0)
+
+  def test_offline_only_uses_cache(self):
+    cache = self.cache()
+    with MockMAR() as mar:
+      self.geocode(mar, addresses[:5], cache=cache)
+    dcgeotools.MAR_URL = "http://127.0.0.1:9/unreachable"
+    result = dcgeotools.geocode(addresses[:10], "test", cache=cache, offline=True)
+    self.assertEqual(result["status"].tolist(), ["ok"] * 5 + ["offline"] * 5)
+    with self.assertRaises(ValueError):
+      dcgeotools.geocode(addresses, "test", offline=True)
+
+  def test_ttl_expiry(self):
+    cache = self.cache(ttl=60)
+    with mock.patch("time.time", return_value=1000.0):
+      cache.put_many({"1 main st nw":{"lat":38.9, "lon":-77.0, "type":"RESIDENTIAL"}})
+    with mock.patch("time.time", return_value=1059.0):
+      self.assertEqual(list(cache.get_many(["1 main st nw"])), ["1 main st nw"])
+    with mock.patch("time.time", return_value=1061.0):
+      self.assertEqual(cache.get_many(["1 main st nw"]), {})
+      # Expired entries are dropped on the next write
+      cache.put_many({"2 main st nw":{"lat":38.9, "lon":-77.0, "type":"RESIDENTIAL"}})
+    self.assertEqual(len(cache), 1)
+    self.assertEqual(cache.stats()["hits"], 1)
+    self.assertEqual(cache.stats()["misses"], 1)
+
+  def test_lru_eviction(self):
+    cache = self.cache(max_entries=2)
+    entry = {"lat":38.9, "lon":-77.0, "type":"RESIDENTIAL"}
+    with mock.patch("time.time", return_value=1.0):
+      cache.put_many({"a":entry, "b":entry})
+    with mock.patch("time.time", return_value=2.0):
+      cache.get_many(["a"])
+    with mock.patch("time.time", return_value=3.0):
+      cache.put_many({"c":entry})
+    self.assertEqual(sorted(cache.get_many(["a", "b", "c"])), ["a", "c"])
+    self.assertEqual(cache.stats()["evictions"], 1)
+
+if __name__ == "__main__":
+  unittest.main()
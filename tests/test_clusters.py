@@ -0,0 +1,82 @@
+import math, unittest
+import numpy as np
+import pandas as pd
+import dcgeotools
+
+# The original pairwise get_clusters, returning the point indices of each cluster
+def reference_clusters(points, cluster_radius_miles=0.5, cluster_number_points=5):
+  def haversine(origin, destination):
+    origin_lat = math.radians(float(origin[0]))
+    origin_lon = math.radians(float(origin[1]))
+    destination_lat = math.radians(float(destination[0]))
+    destination_lon = math.radians(float(destination[1]))
+    lat_delta = destination_lat - origin_lat
+    lon_delta = destination_lon - origin_lon
+    r = 6378127
+    a = math.sin(lat_delta / 2) ** 2 + math.cos(origin_lat) * math.cos(destination_lat) * math.sin(lon_delta / 2) ** 2
+    c = 2 * math.asin(math.sqrt(a))
+    return c * r * 0.000621371
+
+  if len(points) < cluster_number_points: return []
+  records = points.to_dict("records")
+  point_pairs = []
+  for i1, p1 in enumerate(records):
+    if np.isnan(p1["lat"]): continue
+    for i2, p2 in enumerate(records):
+      if np.isnan(p2["lat"]): continue
+      if i1 >= i2: continue
+      distance = haversine([p1["lat"], p1["lon"]], [p2["lat"], p2["lon"]])
+      if np.isnan(distance) or distance > cluster_radius_miles: continue
+      point_pairs.append([i1, i2])
+  if len(point_pairs) < cluster_number_points: return []
+
+  distances = pd.DataFrame(point_pairs, columns=["p1", "p2"])
+  potential_clusters = []
+  for p in np.unique(distances[["p1", "p2"]].values):
+    point_set = np.unique(distances[(distances["p1"] == p) | (distances["p2"] == p)][["p1", "p2"]].values)
+    if len(point_set) >= cluster_number_points:
+      potential_clusters.append(point_set)
+  if len(potential_clusters) < 1: return []
+
+  def get_largest_sets(lst):
+    for x, c in enumerate(lst):
+      common_items = [bool(set(c) & set(i)) if not x == x2 else False for x2, i in enumerate(lst)]
+      if any(common_items):
+        new_list = [item for x, item in enumerate(lst) if not common_items[x]]
+        return get_largest_sets(new_list)
+    return lst
+
+  potential_clusters.sort(key = lambda x:-len(x))
+  return get_largest_sets([c.tolist() for c in potential_clusters])
+
+class TestGetClusters(unittest.TestCase):
+  def test_matches_pairwise_engine(self):
+    rng = np.random.default_rng(0)
+    for trial in range(200):
+      n = int(rng.integers(0, 60))
+      # Tight hot spots so clusters overlap and compete for points
+      spread = rng.choice([0.002, 0.01, 0.05])
+      lat = 38.9 + rng.normal(0, spread, n)
+      lon = -77.0 + rng.normal(0, spread, n)
+      lat[rng.random(n) < 0.05] = np.nan
+      lon[rng.random(n) < 0.05] = np.nan
+      points = pd.DataFrame({"lat":lat, "lon":lon})
+      radius = float(rng.choice([0.1, 0.25, 0.5, 1.0]))
+      number = int(rng.integers(2, 8))
+
+      expected = reference_clusters(points, radius, number)
+      clusters = dcgeotools.get_clusters(points, radius, number)
+      self.assertEqual(len(clusters), len(expected), "trial {}".format(trial))
+      for cluster, indices in zip(clusters.to_dict("records"), expected):
+        cluster_set = points.to_numpy()[indices]
+        np.testing.assert_array_equal(cluster["points"], cluster_set)
+        self.assertEqual(cluster["center"], (cluster_set[:, 0].sum() / len(indices), cluster_set[:, 1].sum() / len(indices)))
+
+  def test_duplicate_points(self):
+    points = pd.DataFrame({"lat":[38.9] * 6 + [38.95], "lon":[-77.0] * 6 + [-77.05]})
+    clusters = dcgeotools.get_clusters(points, 0.0, 5)
+    self.assertEqual(len(clusters), 1)
+    self.assertEqual(len(clusters["points"][0]), 6)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,122 @@
+import os, sys, tempfile, unittest
+import numpy as np
+import dcgeotools
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+from mock_mar import MockMAR, _properties
+
+addresses = ["{} Main St NW".format(i) for i in range(1, 200)] + ["12 Elm Ave. SE, Washington DC", "12 elm ave se", "500 Oak Pl NE Apt 3"]
+
+# Coordinates the mock returns for an address
+def expected(address):
+  properties = _properties(dcgeotools.address_to_MAR(address))
+  return properties["Latitude"], properties["Longitude"]
+
+class MockMARTestCase(unittest.TestCase):
+  def setUp(self):
+    self.url = dcgeotools.MAR_URL
+
+  def tearDown(self):
+    dcgeotools.MAR_URL = self.url
+    dcgeotools.disable_instrumentation()
+
+  def geocode(self, mar, address_data, **options):
+    dcgeotools.MAR_URL = mar.url
+    self.metrics = dcgeotools.enable_instrumentation()
+    try:
+      return dcgeotools.geocode(address_data, "test", **options)
+    finally:
+      dcgeotools.disable_instrumentation()
+
+class TestGeocode(MockMARTestCase):
+  def test_concurrent_results_in_input_order(self):
+    with MockMAR(latency=0.002) as mar:
+      result = self.geocode(mar, addresses, batch_size=10, max_workers=8)
+    self.assertEqual(len(result), len(addresses))
+    self.assertTrue((result["status"] == "ok").all())
+    for address, lat, lon in zip(addresses, result["lat"], result["lon"]):
+      self.assertEqual((lat, lon), expected(address))
+
+  def test_retries_transient_errors(self):
+    with MockMAR(error_rate=0.3, seed=1) as mar:
+      result = self.geocode(mar, addresses, batch_size=10, max_workers=4, retries=10, backoff=0.001)
+    self.assertTrue((result["status"] == "ok").all())
+    self.assertGreater(self.metrics.counters["mar_retries"], 0)
+
+  def test_reuses_connection(self):
+    with MockMAR() as mar:
+      self.geocode(mar, addresses, batch_size=10)
+    distinct = len(set(dcgeotools.address_to_MAR(a) for a in addresses))
+    self.assertEqual(self.metrics.counters["mar_connections"], 1)
+    self.assertEqual(self.metrics.counters["mar_requests"], -(-distinct // 10))
+
+  def test_rate_limit(self):
+    # A bucket of one at 50 per second spaces six requests over 0.1 seconds
+    bucket = dcgeotools._TokenBucket(50, 1)
+    start = dcgeotools.time.monotonic()
+    for i in range(6): bucket.acquire()
+    self.assertGreaterEqual(dcgeotools.time.monotonic() - start, 0.09)
+
+class TestBatchFailures(MockMARTestCase):
+  def test_bad_addresses_are_isolated(self):
+    batch = addresses[:30] + ["zzz unknown place", "nowhere"] + addresses[30:38]
+    with MockMAR() as mar:
+      result = self.geocode(mar, batch, batch_size=40)
+    self.assertEqual(list(result["status"][30:32]), ["not found", "not found"])
+    self.assertTrue((result["status"].drop([30, 31]) == "ok").all())
+    for address, lat in zip(batch[:30], result["lat"]):
+      self.assertEqual(lat, expected(address)[0])
+
+  def test_outage_is_not_bisected(self):
+    with MockMAR(error_rate=1.0) as mar:
+      result = self.geocode(mar, addresses[:40], batch_size=40, retries=2, backoff=0.001)
+    self.assertTrue((result["status"] == "error").all())
+    self.assertEqual(self.metrics.counters["mar_requests"], 3)
+
+  def test_rejected_api_key_is_not_bisected(self):
+    with MockMAR(fail_status=401) as mar:
+      result = self.geocode(mar, addresses[:40], batch_size=40, retries=2, backoff=0.001)
+    self.assertTrue((result["status"] == "error").all())
+    self.assertEqual(self.metrics.counters["mar_requests"], 1)
+
+  def test_unparseable_response_is_not_bisected(self):
+    # A 200 answer without "Results"
+    with MockMAR(fail_status=200) as mar:
+      result = self.geocode(mar, addresses[:40], batch_size=40)
+    self.assertTrue((result["status"] == "error").all())
+    self.assertEqual(self.metrics.counters["mar_requests"], 1)
+
+class TestGeocodeStream(MockMARTestCase):
+  def stream(self, mar, source, output, **options):
+    dcgeotools.MAR_URL = mar.url
+    return dcgeotools.geocode_stream(source, output, "test", chunk_size=10, layers=[], **options)
+
+  def test_resumes_after_completed_chunks(self):
+    with MockMAR() as mar, tempfile.TemporaryDirectory() as tmp:
+      output, checkpoint = os.path.join(tmp, "out.csv"), os.path.join(tmp, "checkpoint.json")
+      self.stream(mar, addresses[:20], output, checkpoint=checkpoint)
+      self.assertEqual(self.stream(mar, addresses[:35], output, checkpoint=checkpoint), {"chunks":4, "rows":35})
+      fresh = os.path.join(tmp, "fresh.csv")
+      self.stream(mar, addresses[:35], fresh)
+      with open(output) as f, open(fresh) as g:
+        self.assertEqual(f.read(), g.read())
+
+  def test_missing_output_is_not_resumed(self):
+    with MockMAR() as mar, tempfile.TemporaryDirectory() as tmp:
+      output, checkpoint = os.path.join(tmp, "out.csv"), os.path.join(tmp, "checkpoint.json")
+      self.stream(mar, addresses[:20], output, checkpoint=checkpoint)
+      os.remove(output)
+      with self.assertRaises(ValueError):
+        self.stream(mar, addresses[:35], output, checkpoint=checkpoint)
+      self.assertFalse(os.path.exists(output))
+
+  def test_chunk_size_must_match_checkpoint(self):
+    with MockMAR() as mar, tempfile.TemporaryDirectory() as tmp:
+      output, checkpoint = os.path.join(tmp, "out.csv"), os.path.join(tmp, "checkpoint.json")
+      self.stream(mar, addresses[:20], output, checkpoint=checkpoint)
+      dcgeotools.MAR_URL = mar.url
+      with self.assertRaises(ValueError):
+        dcgeotools.geocode_stream(addresses[:35], output, "test", chunk_size=5, checkpoint=checkpoint, layers=[])
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,52 @@
+import json, os, tempfile, unittest
+import numpy as np
+import pandas as pd
+import shapely
+import dcgeotools
+from dcgeotools import grid
+
+layers = ["ward", "nhood", "zipcode", "census"]
+
+# Random points over DC and past its edges, plus a sample of polygon vertices
+# and edge midpoints per layer, which sit exactly on region boundaries
+def sample_points(n=20000, per_layer=5000, seed=0):
+  rng = np.random.default_rng(seed)
+  lat = [rng.uniform(38.78, 39.01, n)]
+  lon = [rng.uniform(-77.13, -76.90, n)]
+  for layer in layers:
+    rings = shapely.get_rings(shapely.get_parts(dcgeotools._get_boundaries(layer)[0].geometry.values))
+    coords, ring = shapely.get_coordinates(rings, return_index=True)
+    same_ring = np.flatnonzero(ring[:-1] == ring[1:])
+    vertices = coords[rng.choice(len(coords), per_layer, replace=False)]
+    edges = rng.choice(same_ring, per_layer, replace=False)
+    midpoints = (coords[edges] + coords[edges + 1]) / 2
+    lat += [vertices[:, 1], midpoints[:, 1]]
+    lon += [vertices[:, 0], midpoints[:, 0]]
+  return np.concatenate(lat), np.concatenate(lon)
+
+class TestLookupRegions(unittest.TestCase):
+  def test_matches_get_regions(self):
+    lat, lon = sample_points()
+    regions = dcgeotools.get_regions(pd.DataFrame({"lat":lat, "lon":lon}))
+    lookup = dcgeotools.lookup_regions(lat, lon)
+    for layer in layers:
+      expected = regions[layer].to_numpy(dtype=object)
+      found = pd.notna(expected)
+      np.testing.assert_array_equal(pd.isna(lookup[layer]), ~found, layer)
+      self.assertEqual(lookup[layer][found].tolist(), expected[found].tolist(), layer)
+
+  def test_nan_and_outside_points(self):
+    lookup = dcgeotools.lookup_regions([np.nan, 38.9, 40.0], [-77.0, np.nan, -77.0], ["ward"])
+    self.assertTrue(np.isnan(lookup["ward"]).all())
+
+  def test_shipped_grid_is_current(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      grid.build_grid(tmp)
+      with open(os.path.join(tmp, "grid.json")) as f, open(os.path.join(grid.GRID_PATH, "grid.json")) as g:
+        self.assertEqual(json.load(f), json.load(g))
+      for name in sorted(os.listdir(tmp)):
+        if name.endswith(".npy"):
+          np.testing.assert_array_equal(np.load(os.path.join(tmp, name)), np.load(os.path.join(grid.GRID_PATH, name)), name)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+import dcgeotools
+from test_geocode import MockMAR, MockMARTestCase, addresses
+
+class TestInstrumentation(MockMARTestCase):
+  def test_records_geocode(self):
+    with MockMAR() as mar:
+      self.geocode(mar, addresses, batch_size=10, max_workers=4)
+      request_bytes = mar.request_bytes
+      requests = mar.requests
+    timings, counters = self.metrics.to_dict()["timings"], self.metrics.to_dict()["counters"]
+    self.assertEqual(timings["geocode"]["calls"], 1)
+    self.assertEqual(timings["addresses_to_MAR"]["calls"], 1)
+    self.assertEqual(timings["get_geodata"]["calls"], requests)
+    self.assertGreaterEqual(timings["geocode"]["seconds"], timings["geocode"]["max_seconds"])
+    self.assertEqual(counters["mar_requests"], requests)
+    self.assertLessEqual(counters["mar_connections"], 4)
+    self.assertEqual(counters["mar_bytes_sent"], request_bytes)
+    self.assertGreater(counters["mar_bytes_received"], 0)
+
+  def test_nothing_recorded_while_disabled(self):
+    recorder = dcgeotools.enable_instrumentation()
+    self.assertIs(dcgeotools.disable_instrumentation(), recorder)
+    with MockMAR() as mar:
+      dcgeotools.MAR_URL = mar.url
+      dcgeotools.geocode(addresses[:20], "test", batch_size=10)
+      dcgeotools.get_intersections([(38.9, -77.0)], "test")
+    self.assertIsNone(dcgeotools.instrumentation.get_instrumentation())
+    self.assertEqual(recorder.to_dict(), {"timings":{}, "counters":{}})
+
+  def test_reset_and_json(self):
+    recorder = dcgeotools.Instrumentation()
+    recorder.add_time("geocode", 0.5)
+    recorder.add_time("geocode", 0.25)
+    recorder.count("mar_requests", 3)
+    self.assertEqual(recorder.to_json(sort_keys=True), '{"counters": {"mar_requests": 3}, "timings": {"geocode": {"calls": 2, "max_seconds": 0.5, "seconds": 0.75}}}')
+    recorder.reset()
+    self.assertEqual(recorder.to_dict(), {"timings":{}, "counters":{}})
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,60 @@
+import contextlib, io, unittest
+import numpy as np
+import dcgeotools
+from test_geocode import MockMAR, MockMARTestCase
+
+locations = [(38.9 + i / 1000, -77.0 - i / 1000) for i in range(30)] + ["{} Main St NW".format(i) for i in range(1, 11)]
+
+class TestIntersections(MockMARTestCase):
+  def setUp(self):
+    super().setUp()
+    dcgeotools._square_intersections.entries.clear()
+
+  def intersections(self, mar, locations, **options):
+    dcgeotools.MAR_URL = mar.url
+    self.metrics = dcgeotools.enable_instrumentation()
+    try:
+      return dcgeotools.get_intersections(locations, "test", **options)
+    finally:
+      dcgeotools.disable_instrumentation()
+
+  def test_matches_get_intersection_in_input_order(self):
+    with MockMAR(latency=0.002) as mar:
+      result = self.intersections(mar, locations[::-1] + locations)
+      dcgeotools._square_intersections.entries.clear()
+      expected = [dcgeotools.get_intersection(loc_data, "test") for loc_data in locations[::-1] + locations]
+    self.assertEqual(result, expected)
+    self.assertTrue(all(isinstance(intersection, str) and " AND " in intersection for intersection in result))
+
+  def test_each_location_and_square_requested_once(self):
+    with MockMAR() as mar:
+      result = self.intersections(mar, locations * 3)
+    squares = self.metrics.counters["square_cache_misses"]
+    self.assertEqual(self.metrics.counters["mar_requests"], len(locations) + squares)
+    self.assertLess(squares, len(locations))
+    self.assertEqual(result, result[:len(locations)] * 3)
+
+  def test_squares_reused_across_calls(self):
+    with MockMAR() as mar:
+      first = self.intersections(mar, locations)
+      squares = self.metrics.counters["square_cache_misses"]
+      second = self.intersections(mar, locations)
+    self.assertEqual(first, second)
+    self.assertNotIn("square_cache_misses", self.metrics.counters)
+    self.assertEqual(self.metrics.counters["square_cache_hits"], squares)
+    self.assertEqual(self.metrics.counters["mar_requests"], len(locations))
+
+  def test_unknown_location_is_nan(self):
+    with MockMAR() as mar:
+      result = self.intersections(mar, ["zzz q", locations[0]])
+      dcgeotools.MAR_URL = mar.url
+      output = io.StringIO()
+      with contextlib.redirect_stdout(output):
+        single = dcgeotools.get_intersection("zzz q", "test")
+    self.assertTrue(np.isnan(result[0]))
+    self.assertIsInstance(result[1], str)
+    self.assertTrue(np.isnan(single))
+    self.assertEqual(output.getvalue(), "")
+
+if __name__ == "__main__":
+  unittest.main()
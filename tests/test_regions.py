@@ -0,0 +1,73 @@
+import unittest
+from unittest import mock
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pkg_resources, shapely
+import dcgeotools
+
+layers = ["ward", "nhood", "zipcode", "census"]
+
+# Random points over DC and past its edges, plus polygon vertices, which lie on
+# shared edges and match more than one polygon
+def sample_points(n=3000, seed=0):
+  rng = np.random.default_rng(seed)
+  lat = rng.uniform(38.78, 39.01, n)
+  lon = rng.uniform(-77.13, -76.90, n)
+  for layer in layers:
+    coords = shapely.get_coordinates(dcgeotools._get_boundaries(layer)[0].geometry.values)
+    coords = coords[rng.choice(len(coords), 200, replace=False)]
+    lat, lon = np.append(lat, coords[:, 1]), np.append(lon, coords[:, 0])
+  # Non-default index to check it is carried through
+  return pd.DataFrame({"lat":lat, "lon":lon}, index=np.arange(len(lat)) * 3 + 7)
+
+# The original get_ward/get_nhood/get_zipcode/get_census
+def reference_layer(points, layer):
+  geo_points = gpd.GeoDataFrame(points, geometry = gpd.points_from_xy(points["lon"].to_list(), points["lat"].to_list()))
+  area = gpd.read_file(pkg_resources.resource_filename('dcgeotools', dcgeotools._boundary_layers[layer]["shapefile"]))
+  results = gpd.sjoin(geo_points, area)[["geometry", "index_right"]].rename(columns={"index_right":layer})
+  labels = dcgeotools._boundary_layers[layer]["labels"]
+  results[layer] = [labels[i] for i in results[layer].to_list()]
+  return results
+
+class TestRegions(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.points = sample_points()
+
+  def test_layer_functions_match_sjoin(self):
+    functions = {"ward":dcgeotools.get_ward, "nhood":dcgeotools.get_nhood, "zipcode":dcgeotools.get_zipcode, "census":dcgeotools.get_census}
+    for layer, function in functions.items():
+      results = function(self.points)
+      expected = reference_layer(self.points, layer)
+      self.assertEqual(results.index.tolist(), expected.index.tolist(), layer)
+      self.assertEqual(results[layer].tolist(), expected[layer].tolist(), layer)
+      self.assertTrue(results.geometry.geom_equals(expected.geometry).all(), layer)
+
+  def test_get_regions_takes_first_match(self):
+    regions = dcgeotools.get_regions(self.points)
+    self.assertEqual(regions.index.tolist(), self.points.index.tolist())
+    for layer in layers:
+      # Lowest polygon index on shared edges, like lookup_regions
+      geo_points = gpd.GeoDataFrame(self.points, geometry = gpd.points_from_xy(self.points["lon"].to_list(), self.points["lat"].to_list()))
+      area = gpd.read_file(pkg_resources.resource_filename('dcgeotools', dcgeotools._boundary_layers[layer]["shapefile"]))
+      first = gpd.sjoin(geo_points, area)["index_right"].groupby(level=0).min()
+      expected = first.map(lambda i: dcgeotools._boundary_layers[layer]["labels"][i])
+      labels = regions[layer]
+      self.assertEqual(labels[labels.notna()].to_dict(), expected.to_dict(), layer)
+
+  def test_shapefiles_read_once(self):
+    dcgeotools._boundaries.clear()
+    with mock.patch("geopandas.read_file", wraps=gpd.read_file) as read_file:
+      dcgeotools.get_regions(self.points.head(100))
+      self.assertEqual(read_file.call_count, len(layers))
+      dcgeotools.get_regions(self.points.head(100))
+      dcgeotools.get_ward(self.points.head(100))
+      self.assertEqual(read_file.call_count, len(layers))
+
+  def test_unknown_layer(self):
+    with self.assertRaises(ValueError):
+      dcgeotools.get_regions(self.points.head(10), ["county"])
+
+if __name__ == "__main__":
+  unittest.main()